@@ -1,8 +1,51 @@
-from flask import Flask, jsonify
+import os
+import json
+import math
+import threading
+from flask import Flask, Response, jsonify, request, stream_with_context
 from stage_manager import StageDataManager
+from config_manager import ConfigManager, get_current_profile
+from change_feed import ChangeFeed
 
 app = Flask(__name__)
-stage_manager = StageDataManager()
+
+# 关卡数据和实例状态的变更通过同一个版本化变更流推送给客户端
+change_feed = ChangeFeed()
+stage_manager = StageDataManager(change_feed=change_feed)
+
+# 实例接口只读取内存缓存，远程同步由后台调度器完成
+config_manager = ConfigManager(cache_dir=os.path.join('cache', 'instances'), change_feed=change_feed)
+
+background_started = False
+background_lock = threading.Lock()
+
+
+def start_background():
+    """加载实例并启动后台任务（关卡检查、同步调度），重复调用无效
+
+    不在导入时执行：调试模式下 reloader 的父进程也会导入本模块，
+    否则会有两个进程同时同步同一批实例、写同一份缓存。
+    """
+    global background_started
+    with background_lock:
+        if background_started:
+            return
+        background_started = True
+    stage_manager.start_watcher()
+    instances_file = os.environ.get('MAA_INSTANCES_FILE', 'instances.json')
+    if os.path.exists(instances_file):
+        config_manager.load_instances(instances_file, refresh=False)
+        config_manager.start_scheduler()
+
+
+@app.before_request
+def ensure_background():
+    """由WSGI服务器加载时（不经过 __main__）在第一个请求前启动后台任务"""
+    if not app.testing:
+        start_background()
+
+MAX_POLL_TIMEOUT = 60  # 长轮询最长等待时间（秒）
+SSE_HEARTBEAT = 15  # SSE空闲时发送心跳的间隔（秒）
 
 @app.route('/api/stages', methods=['GET'])
 def get_stages():
@@ -22,5 +65,141 @@ def get_open_stages():
     open_stages = stage_manager.get_open_stages()
     return jsonify(open_stages)
 
+@app.route('/api/instances', methods=['GET'])
+def get_instances():
+    """获取所有实例状态"""
+    return jsonify([config_manager.get_instance_status(name) for name in list(config_manager.instances)])
+
+@app.route('/api/instances/query', methods=['GET'])
+def query_instances():
+    """按索引查询实例
+
+    ?index=stage&value=CE-6 返回匹配的实例名；省略 value 时返回该索引的全部取值。
+    """
+    index = request.args.get('index', 'stage')
+    if index not in config_manager.indexes:
+        return jsonify({'success': False, 'error': 'Index not found'}), 404
+    if 'value' not in request.args:
+        values = config_manager.index_values(index)
+        return jsonify([{'value': value, 'instances': names} for value, names in values.items()])
+    return jsonify(config_manager.query(index, request.args['value']))
+
+@app.route('/api/instances/stale-stages', methods=['GET'])
+def get_stale_stages():
+    """获取配置了当日未开放关卡的实例"""
+    return jsonify(config_manager.find_stale_stages(stage_manager))
+
+@app.route('/api/instances/<name>', methods=['GET'])
+def get_instance(name):
+    """获取实例状态"""
+    status = config_manager.get_instance_status(name)
+    if status is None:
+        return jsonify({'success': False, 'error': 'Instance not found'}), 404
+    return jsonify(status)
+
+@app.route('/api/instances/<name>/config', methods=['GET'])
+def get_instance_config(name):
+    """获取实例配置（附带在线状态和同步时间）"""
+    status = config_manager.get_instance_status(name, include_config=True)
+    if status is None:
+        return jsonify({'success': False, 'error': 'Instance not found'}), 404
+    return jsonify(status)
+
+@app.route('/api/instances/<name>/config', methods=['POST'])
+def update_instance_config(name):
+    """提交配置更新任务
+
+    请求体 {"config": {...}} 替换整个配置，{"changes": {...}} 合并到当前配置方案。
+    """
+    if name not in config_manager.instances:
+        return jsonify({'success': False, 'error': 'Instance not found'}), 404
+
+    body = request.get_json(silent=True) or {}
+    require_loaded = True
+    if isinstance(body.get('config'), dict):
+        new_config = body['config']
+        # 替换整个配置不依赖当前配置
+        require_loaded = False
+
+        def mutate(instance, config):
+            return new_config
+    elif isinstance(body.get('changes'), dict):
+        if not config_manager.instances[name].loaded:
+            return jsonify({'success': False, 'error': 'Instance config has not been loaded'}), 409
+        changes = body['changes']
+
+        def mutate(instance, config):
+            get_current_profile(config).update(changes)
+            return config
+    else:
+        return jsonify({'success': False, 'error': 'Request body must contain "config" or "changes"'}), 400
+
+    job_id = config_manager.queue_update(name, mutate, require_loaded=require_loaded)
+    return jsonify({'success': True, 'job_id': job_id}), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """获取配置更新任务状态"""
+    job = config_manager.get_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    return jsonify(job)
+
+def get_cursor():
+    """读取客户端游标：Last-Event-ID（SSE重连时浏览器自动发送）或 ?since="""
+    value = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+@app.route('/api/changes', methods=['GET'])
+def get_changes():
+    """长轮询获取变更
+
+    ?since=<版本号> 返回该版本之后的事件，没有新事件时最多等待 ?timeout= 秒（默认30）。
+    不带 since 时立即返回当前版本号作为起始游标。reset 为True表示游标已过期，
+    需要重新获取完整状态（/api/stages/open、/api/instances）后从返回的版本号继续。
+    """
+    cursor = get_cursor()
+    if cursor is None:
+        return jsonify({'version': change_feed.version, 'events': [], 'reset': False})
+
+    timeout = request.args.get('timeout', 30, type=float)
+    if not math.isfinite(timeout):
+        # nan 会让等待永不超时，占住处理线程
+        return jsonify({'success': False, 'error': 'timeout must be a finite number'}), 400
+    timeout = min(max(timeout, 0), MAX_POLL_TIMEOUT)
+    events, reset = change_feed.wait(cursor, timeout)
+    version = events[-1]['version'] if events else (change_feed.version if reset else cursor)
+    return jsonify({'version': version, 'events': events, 'reset': reset})
+
+@app.route('/api/changes/stream', methods=['GET'])
+def stream_changes():
+    """以Server-Sent Events推送变更，事件id为版本号，断线重连后从Last-Event-ID继续"""
+    cursor = get_cursor()
+    if cursor is None:
+        cursor = change_feed.version
+
+    def generate(cursor):
+        while True:
+            events, reset = change_feed.wait(cursor, SSE_HEARTBEAT)
+            if reset:
+                cursor = change_feed.version
+                yield f"id: {cursor}\nevent: reset\ndata: {{}}\n\n"
+                continue
+            if not events:
+                yield ": heartbeat\n\n"
+                continue
+            for event in events:
+                yield f"id: {event['version']}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+            cursor = events[-1]['version']
+
+    return Response(stream_with_context(generate(cursor)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    # 调试模式下只在 reloader 的子进程（实际处理请求的进程）中启动后台任务
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background()
+    app.run(debug=True, port=5000, threaded=True)
@@ -0,0 +1,59 @@
+import time
+import threading
+from collections import deque
+from typing import List, Optional, Tuple
+
+
+class ChangeFeed:
+    """版本化变更流
+
+    每个事件带有单调递增的版本号，客户端记录最后收到的版本号作为游标，
+    之后只获取比游标新的事件。只保留最近 max_events 个事件，游标早于保留范围时
+    需要客户端重新获取完整状态（reset）。
+
+    事件格式：{'version', 'time', 'source', 'type', 'key', 'data'}
+    - source 为 'stages'（关卡数据）或 'instance'（MAA实例）
+    - key 为客户端类型或实例名
+    """
+
+    def __init__(self, max_events: int = 1000):
+        self.events = deque(maxlen=max_events)
+        self.version = 0  # 最新事件的版本号
+        self.condition = threading.Condition()
+
+    def publish(self, source: str, event_type: str, key: str, data: Optional[dict] = None) -> int:
+        """发布事件并唤醒等待中的客户端，返回事件版本号"""
+        with self.condition:
+            self.version += 1
+            self.events.append({
+                'version': self.version,
+                'time': time.time(),
+                'source': source,
+                'type': event_type,
+                'key': key,
+                'data': data or {},
+            })
+            self.condition.notify_all()
+            return self.version
+
+    def _since(self, version: int) -> Tuple[List[dict], bool]:
+        # 游标之后的事件已被淘汰时返回reset，由客户端重新获取完整状态
+        if self.events and version < self.events[0]['version'] - 1:
+            return [], True
+        if version > self.version:
+            return [], True
+        return [event for event in self.events if event['version'] > version], False
+
+    def since(self, version: int) -> Tuple[List[dict], bool]:
+        """返回 (版本号大于 version 的事件, 是否需要重新获取完整状态)"""
+        with self.condition:
+            return self._since(version)
+
+    def wait(self, version: int, timeout: float) -> Tuple[List[dict], bool]:
+        """等待直到有比 version 新的事件或超时（长轮询）
+
+        等待期间线程阻塞在条件变量上，不占用CPU。
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self._since(version)
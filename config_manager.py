@@ -1,97 +1,573 @@
 import os
+import copy
+import contextlib
 import json
 import time
+import gzip
+import base64
+import bisect
+import zlib
+import select
+import hashlib
+import binascii
+import heapq
+import random
 import logging
+import uuid
+import itertools
+import threading
 import paramiko
-from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 远程操作延迟直方图的分桶上界（秒），最后一个桶为 +inf
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# MAA gui.json 中的配置项
+STAGE_KEY = 'MainFunction.Stage1'  # 刷理智关卡
+CLIENT_TYPE_KEY = 'Start.ClientType'  # 客户端类型
+
+# 客户端类型 -> StageActivity.json 中的区服
+CLIENT_REGIONS = {
+    '': 'Official',
+    'Official': 'Official',
+    'Bilibili': 'Official',
+    'YoStarEN': 'YoStarEN',
+    'YoStarJP': 'YoStarJP',
+    'YoStarKR': 'YoStarKR',
+    'txwy': 'txwy',
+}
+
+
+class CommandStream:
+    """远程命令的流式输出
+
+    迭代时同时读取stdout和stderr（避免stderr写满导致远端阻塞），按块产出stdout数据，
+    stderr只保留末尾 max_stderr_bytes 字节。stdout累计超过 max_output_bytes 时关闭通道并停止。
+    迭代结束后可读取 exit_code、error、stderr。
+    """
+
+    OVERSIZED_HEAD_BYTES = 256  # 超长行回调时保留的行首字节数
+
+    def __init__(self, channel: Optional[paramiko.Channel], max_output_bytes: int,
+                 timeout: float, chunk_size: int = 32768, max_stderr_bytes: int = 65536,
+                 error: Optional[str] = None, on_finish: Optional[Callable[['CommandStream'], None]] = None):
+        self.channel = channel
+        self.max_output_bytes = max_output_bytes  # stdout上限（字节）
+        self.timeout = timeout  # 整个命令的超时（秒）
+        self.chunk_size = chunk_size
+        self.max_stderr_bytes = max_stderr_bytes
+        self.bytes_read = 0  # 已读取的stdout字节数
+        self.exit_code = None  # 远端退出码，未正常结束时为None
+        self.error = error  # 连接失败、超时或超出上限时的错误信息
+        self.limit_exceeded = False  # 是否因输出超出上限而停止（远端已正常执行）
+        self.first_byte_time = None  # 收到第一块stdout的时间
+        self.on_finish = on_finish  # 通道关闭后回调（用于追踪）
+        self._stderr = bytearray()
+
+    @property
+    def stderr(self) -> str:
+        return self._stderr.decode('utf-8', errors='replace')
+
+    @property
+    def success(self) -> bool:
+        return self.error is None and self.exit_code == 0
+
+    def _read_stderr(self):
+        self._stderr += self.channel.recv_stderr(self.chunk_size)
+        if len(self._stderr) > self.max_stderr_bytes:
+            del self._stderr[:len(self._stderr) - self.max_stderr_bytes]
+
+    def __iter__(self) -> Iterator[bytes]:
+        if self.channel is None:
+            return
+        deadline = time.time() + self.timeout
+        try:
+            while True:
+                stderr_ready = self.channel.recv_stderr_ready()
+                if stderr_ready:
+                    self._read_stderr()
+                if self.channel.recv_ready():
+                    data = self.channel.recv(self.chunk_size)
+                    self.bytes_read += len(data)
+                    if self.first_byte_time is None:
+                        self.first_byte_time = time.time()
+                    if self.bytes_read > self.max_output_bytes:
+                        self.error = f"Output exceeded {self.max_output_bytes} bytes"
+                        self.limit_exceeded = True
+                        return
+                    yield data
+                    continue
+                if stderr_ready:
+                    continue
+                if self.channel.exit_status_ready():
+                    # 退出状态可能先于最后的数据到达，再检查一次缓冲区
+                    if self.channel.recv_ready() or self.channel.recv_stderr_ready():
+                        continue
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.error = f"Command timed out after {self.timeout} seconds"
+                    return
+                select.select([self.channel], [], [], min(remaining, 0.5))
+            self.exit_code = self.channel.recv_exit_status()
+        finally:
+            self.channel.close()
+            if self.on_finish:
+                self.on_finish(self)
+
+    def lines(self, max_line_bytes: Optional[int] = None,
+              on_oversized: Optional[Callable[[bytes], None]] = None) -> Iterator[bytes]:
+        """按行产出stdout（不含换行符），同一时间只缓存一行
+
+        单行超过 max_line_bytes 字节时：指定了 on_oversized 则用该行开头的
+        OVERSIZED_HEAD_BYTES 字节调用它并跳过该行，否则设置 error、关闭通道并停止。
+        """
+        buffer = bytearray()
+        skipping = False  # 正在丢弃超长行的剩余部分
+        chunks = iter(self)
+        try:
+            for chunk in chunks:
+                if skipping:
+                    end = chunk.find(b'\n')
+                    if end < 0:
+                        continue
+                    chunk = chunk[end + 1:]
+                    skipping = False
+                buffer += chunk
+                start = 0
+                while True:
+                    end = buffer.find(b'\n', start)
+                    if end < 0:
+                        break
+                    yield self._take_line(buffer, start, end)
+                    start = end + 1
+                del buffer[:start]
+                if max_line_bytes is not None and len(buffer) > max_line_bytes:
+                    if on_oversized is None:
+                        self.error = f"Output line exceeded {max_line_bytes} bytes"
+                        self.limit_exceeded = True
+                        return
+                    on_oversized(bytes(buffer[:self.OVERSIZED_HEAD_BYTES]))
+                    buffer.clear()
+                    skipping = True
+            # 超时或超出上限时最后一行不完整，不产出
+            if buffer and self.error is None:
+                yield self._take_line(buffer, 0, len(buffer))
+        finally:
+            # 提前停止时关闭生成器，确保通道关闭并完成追踪
+            chunks.close()
+
+    @staticmethod
+    def _take_line(buffer: bytearray, start: int, end: int) -> bytes:
+        """复制一行（去掉行尾的\r），只产生一次拷贝"""
+        if end > start and buffer[end - 1] == 0x0d:
+            end -= 1
+        with memoryview(buffer) as view:
+            return bytes(view[start:end])
+
+
+class SSHTracer:
+    """远程操作追踪
+
+    每次远程执行记录一个span：操作类型、实例、跳板机、目标主机、收发字节数，以及
+    连接跳板机、打开通道、收到首字节和总耗时。按目标主机汇总次数、错误数、字节数和
+    延迟直方图，按跳板机统计连接、重连和通道打开次数。
+    超过 slow_threshold 秒的操作记录WARNING日志；sink 可接收每个完成的span。
+    """
+
+    def __init__(self, slow_threshold: Optional[float] = None, max_spans: int = 200,
+                 sink: Optional[Callable[[dict], None]] = None):
+        self.slow_threshold = slow_threshold  # 慢操作日志阈值（秒），None表示不记录
+        self.sink = sink
+        self.spans = deque(maxlen=max_spans)  # 最近完成的span
+        self.hosts = {}  # 目标主机 -> 汇总统计
+        self.jumpboxes = {}  # 跳板机 -> 连接事件计数
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def context(self, **tags):
+        """为当前线程中的远程操作附加标签（如 instance）"""
+        previous = getattr(self._local, 'tags', {})
+        self._local.tags = {**previous, **tags}
+        try:
+            yield
+        finally:
+            self._local.tags = previous
+
+    def start_span(self, operation: str, jumpbox_host: str, target_host: str, bytes_out: int = 0) -> dict:
+        span = {
+            'operation': operation,
+            'instance': None,
+            'jumpbox': jumpbox_host,
+            'host': target_host,
+            'start': time.time(),
+            'connect_seconds': None,  # 获取跳板机连接（含重连）
+            'open_seconds': None,  # 打开通道并发送命令
+            'first_byte_seconds': None,  # 从开始到收到第一块输出
+            'seconds': None,
+            'bytes_out': bytes_out,
+            'bytes_in': 0,
+            'success': False,
+            'error': None,
+        }
+        span.update(getattr(self._local, 'tags', {}))
+        return span
+
+    def finish_span(self, span: dict, success: bool, bytes_in: int = 0, error: Optional[str] = None):
+        span['seconds'] = time.time() - span['start']
+        span['bytes_in'] = bytes_in
+        span['success'] = success
+        span['error'] = error
+
+        with self.lock:
+            stats = self.hosts.get(span['host'])
+            if stats is None:
+                stats = self.hosts[span['host']] = {
+                    'round_trips': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0,
+                    'total_seconds': 0.0, 'max_seconds': 0.0,
+                    'operations': {}, 'histogram': [0] * (len(LATENCY_BUCKETS) + 1),
+                }
+            stats['round_trips'] += 1
+            stats['errors'] += 0 if success else 1
+            stats['bytes_in'] += bytes_in
+            stats['bytes_out'] += span['bytes_out']
+            stats['total_seconds'] += span['seconds']
+            stats['max_seconds'] = max(stats['max_seconds'], span['seconds'])
+            stats['operations'][span['operation']] = stats['operations'].get(span['operation'], 0) + 1
+            stats['histogram'][bisect.bisect_left(LATENCY_BUCKETS, span['seconds'])] += 1
+            self.spans.append(span)
+
+        if self.slow_threshold is not None and span['seconds'] >= self.slow_threshold:
+            logger.warning(
+                f"Slow {span['operation']} on {span['host']} (instance {span['instance']}): "
+                f"{span['seconds']:.3f}s total, connect {span['connect_seconds'] or 0:.3f}s, "
+                f"open {span['open_seconds'] or 0:.3f}s, first byte {span['first_byte_seconds'] or 0:.3f}s, "
+                f"{span['bytes_out']} bytes out, {bytes_in} bytes in"
+            )
+        if self.sink:
+            try:
+                self.sink(span)
+            except Exception as e:
+                logger.error(f"Trace sink failed: {str(e)}")
+
+    def count(self, jumpbox_host: str, event: str):
+        """跳板机连接事件计数（connects / reconnects / connect_failures / channels）"""
+        with self.lock:
+            counters = self.jumpboxes.setdefault(jumpbox_host, {})
+            counters[event] = counters.get(event, 0) + 1
+
+    def snapshot(self) -> dict:
+        """返回汇总统计的副本，直方图以分桶上界为键（非累计）"""
+        labels = [str(bound) for bound in LATENCY_BUCKETS] + ['inf']
+        with self.lock:
+            hosts = {}
+            for host, stats in self.hosts.items():
+                hosts[host] = dict(stats, operations=dict(stats['operations']),
+                                   histogram=dict(zip(labels, stats['histogram'])),
+                                   avg_seconds=stats['total_seconds'] / stats['round_trips'])
+            return {
+                'round_trips': sum(stats['round_trips'] for stats in self.hosts.values()),
+                'hosts': hosts,
+                'jumpboxes': {key: dict(counters) for key, counters in self.jumpboxes.items()},
+            }
+
+    def recent_spans(self) -> List[dict]:
+        with self.lock:
+            return [dict(span) for span in self.spans]
+
+    def reset(self):
+        with self.lock:
+            self.hosts.clear()
+            self.jumpboxes.clear()
+            self.spans.clear()
+
 
 class SSHConnectionManager:
     """SSH连接管理器 - 支持跳板机"""
 
-    def __init__(self, connection_timeout=10, command_timeout=30):
+    def __init__(self, connection_timeout=10, command_timeout=30, max_output_bytes=64 * 1024 * 1024,
+                 max_line_bytes=16 * 1024 * 1024, tracer: Optional[SSHTracer] = None):
         self.clients = {}
         self.jumpbox_clients = {}
         self.connection_timeout = connection_timeout
         self.command_timeout = command_timeout
+        self.max_output_bytes = max_output_bytes  # 单条命令stdout上限（字节）
+        self.max_line_bytes = max_line_bytes  # 批量读取时单个文件（一行输出）的上限（字节）
+        self.lock = threading.Lock()  # 保护跳板机连接表（只在读写字典时短暂持有）
+        self.connect_locks = {}  # 跳板机 -> 建立连接用的锁
+        self.tracer = tracer or SSHTracer()
 
     def get_jumpbox_client(self, jumpbox_host: str, jumpbox_username: str, jumpbox_password: str) -> Optional[
         paramiko.SSHClient]:
-        """获取或创建跳板机连接"""
+        """获取或创建跳板机连接，jumpbox_host 可带端口（host:port）
+
+        已有连接只检查本地传输层状态（不发送命令），断开的连接在打开通道失败时由
+        stream_command_via_jumpbox 丢弃并重连。建立连接时只持有该跳板机自己的锁，
+        不会阻塞其他跳板机上的操作。
+        """
         key = f"{jumpbox_username}@{jumpbox_host}"
+        host, _, port = jumpbox_host.partition(':')
 
-        # 检查现有连接是否有效
-        if key in self.jumpbox_clients:
-            client = self.jumpbox_clients[key]
-            try:
-                # 发送空命令测试连接
-                client.exec_command('echo test', timeout=2)
+        with self.lock:
+            client = self.jumpbox_clients.get(key)
+            connect_lock = self.connect_locks.setdefault(key, threading.Lock())
+        if self.is_client_active(client):
+            return client
+
+        # 同一跳板机只由一个线程重连，其余线程等待后复用新连接
+        with connect_lock:
+            with self.lock:
+                client = self.jumpbox_clients.get(key)
+            if self.is_client_active(client):
                 return client
-            except:
-                # 连接已断开，关闭并移除
+            if client is not None:
                 logger.info(f"Connection to jumpbox {key} is broken, will reconnect")
-                try:
-                    client.close()
-                except:
-                    pass
-                del self.jumpbox_clients[key]
+                self.tracer.count(jumpbox_host, 'reconnects')
+                self.drop_jumpbox_client(key, client)
+
+            # 创建新连接
+            try:
+                client = paramiko.SSHClient()
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                client.connect(
+                    host,
+                    port=int(port) if port else 22,
+                    username=jumpbox_username,
+                    password=jumpbox_password,
+                    timeout=self.connection_timeout
+                )
+                with self.lock:
+                    self.jumpbox_clients[key] = client
+                self.tracer.count(jumpbox_host, 'connects')
+                logger.info(f"Successfully connected to jumpbox {key}")
+                return client
+            except Exception as e:
+                self.tracer.count(jumpbox_host, 'connect_failures')
+                logger.error(f"Failed to connect to jumpbox {key}: {str(e)}")
+                return None
+
+    @staticmethod
+    def is_client_active(client: Optional[paramiko.SSHClient]) -> bool:
+        """检查连接的传输层是否仍然活动（本地状态，不产生网络往返）"""
+        if client is None:
+            return False
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
 
-        # 创建新连接
+    def drop_jumpbox_client(self, key: str, client: paramiko.SSHClient):
+        """关闭并移除跳板机连接（已被其他线程替换时只关闭旧连接）"""
+        with self.lock:
+            if self.jumpbox_clients.get(key) is client:
+                del self.jumpbox_clients[key]
         try:
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(
-                jumpbox_host,
-                username=jumpbox_username,
-                password=jumpbox_password,
-                timeout=self.connection_timeout
-            )
-            self.jumpbox_clients[key] = client
-            logger.info(f"Successfully connected to jumpbox {key}")
-            return client
-        except Exception as e:
-            logger.error(f"Failed to connect to jumpbox {key}: {str(e)}")
-            return None
+            client.close()
+        except:
+            pass
+
+    def stream_command_via_jumpbox(self,
+                                   jumpbox_host: str,
+                                   jumpbox_username: str,
+                                   jumpbox_password: str,
+                                   target_host: str,
+                                   target_username: str,
+                                   target_password: str,
+                                   command: str,
+                                   input_data: Optional[bytes] = None,
+                                   timeout: Optional[float] = None,
+                                   max_output_bytes: Optional[int] = None,
+                                   operation: str = 'exec') -> CommandStream:
+        """通过跳板机执行命令，返回流式输出
+
+        input_data 会写入远端命令的标准输入，适合传输超出命令行长度限制的数据；
+        timeout 默认为 command_timeout，max_output_bytes 默认为 max_output_bytes。
+        operation 为追踪记录中的操作类型，输出读取完毕（通道关闭）时结束span。
+        """
+        timeout = timeout or self.command_timeout
+        max_output_bytes = max_output_bytes or self.max_output_bytes
+        span = self.tracer.start_span(operation, jumpbox_host, target_host,
+                                      len(command) + len(input_data or b''))
 
-    def execute_command_via_jumpbox(self,
-                                    jumpbox_host: str,
-                                    jumpbox_username: str,
-                                    jumpbox_password: str,
-                                    target_host: str,
-                                    target_username: str,
-                                    target_password: str,
-                                    command: str) -> Tuple[bool, str]:
-        """通过跳板机执行命令"""
         # 获取跳板机连接
         jumpbox = self.get_jumpbox_client(jumpbox_host, jumpbox_username, jumpbox_password)
+        span['connect_seconds'] = time.time() - span['start']
         if not jumpbox:
-            return False, "Failed to connect to jumpbox"
+            self.tracer.finish_span(span, False, error="Failed to connect to jumpbox")
+            return CommandStream(None, max_output_bytes, timeout, error="Failed to connect to jumpbox")
 
         # 构建在跳板机上执行的SSH命令
         # 注意: 使用明确的字符串连接，不使用f-string
         ssh_command = 'sshpass -p "' + target_password + '" ssh -o StrictHostKeyChecking=no ' + target_username + '@' + target_host + ' "' + command.replace(
             '"', '\\"') + '"'
 
+        def finish(stream: CommandStream):
+            if stream.first_byte_time is not None:
+                span['first_byte_seconds'] = stream.first_byte_time - span['start']
+            error = stream.error
+            if error is None and stream.exit_code != 0:
+                error = f"Exit code {stream.exit_code}"
+            self.tracer.finish_span(span, stream.success, stream.bytes_read + len(stream._stderr), error)
+
         try:
             # 在跳板机上执行连接目标主机的命令
-            _, stdout, stderr = jumpbox.exec_command(ssh_command, timeout=self.command_timeout)
-            exit_code = stdout.channel.recv_exit_status()
-
-            if exit_code != 0:
-                error = stderr.read().decode('utf-8', errors='replace')
-                logger.error(f"Command failed with exit code {exit_code}: {error}")
-                return False, error
+            opened = time.time()
+            try:
+                channel = jumpbox.get_transport().open_session(timeout=timeout)
+            except (paramiko.SSHException, EOFError, OSError) as e:
+                # 连接已失效（命令尚未发送，可以安全重试）：丢弃后重连一次
+                logger.info(f"Failed to open channel on jumpbox {jumpbox_host}, reconnecting: {str(e)}")
+                self.drop_jumpbox_client(f"{jumpbox_username}@{jumpbox_host}", jumpbox)
+                jumpbox = self.get_jumpbox_client(jumpbox_host, jumpbox_username, jumpbox_password)
+                if not jumpbox:
+                    raise
+                channel = jumpbox.get_transport().open_session(timeout=timeout)
+            self.tracer.count(jumpbox_host, 'channels')
+            channel.settimeout(timeout)
+            channel.exec_command(ssh_command)
+            if input_data is not None:
+                channel.sendall(input_data)
+            channel.shutdown_write()
+            span['open_seconds'] = time.time() - opened
+            return CommandStream(channel, max_output_bytes, timeout, on_finish=finish)
+        except Exception as e:
+            logger.error(f"Failed to execute command via jumpbox: {str(e)}")
+            self.tracer.finish_span(span, False, error=str(e))
+            return CommandStream(None, max_output_bytes, timeout, error=str(e))
 
-            result = stdout.read().decode('utf-8', errors='replace')
-            return True, result
+    def execute_command_via_jumpbox(self,
+                                    jumpbox_host: str,
+                                    jumpbox_username: str,
+                                    jumpbox_password: str,
+                                    target_host: str,
+                                    target_username: str,
+                                    target_password: str,
+                                    command: str,
+                                    input_data: Optional[bytes] = None,
+                                    timeout: Optional[float] = None,
+                                    operation: str = 'exec') -> Tuple[bool, str]:
+        """通过跳板机执行命令，返回全部输出"""
+        stream = self.stream_command_via_jumpbox(
+            jumpbox_host, jumpbox_username, jumpbox_password,
+            target_host, target_username, target_password,
+            command, input_data, timeout, operation=operation
+        )
+        try:
+            output = bytearray()
+            for chunk in stream:
+                output += chunk
         except Exception as e:
             logger.error(f"Failed to execute command via jumpbox: {str(e)}")
             return False, str(e)
 
+        if stream.error:
+            logger.error(f"Failed to execute command via jumpbox: {stream.error}")
+            return False, stream.error
+        if stream.exit_code != 0:
+            error = stream.stderr
+            logger.error(f"Command failed with exit code {stream.exit_code}: {error}")
+            return False, error
+        return True, output.decode('utf-8', errors='replace')
+
+    @staticmethod
+    def quote_powershell(value: str) -> str:
+        """将字符串转义为PowerShell单引号字面量"""
+        return "'" + value.replace("'", "''") + "'"
+
+    @staticmethod
+    def build_powershell_command(script: str) -> str:
+        """构建PowerShell命令
+
+        使用 -EncodedCommand 传递脚本（UTF-16LE + Base64），脚本中的引号、$ 等字符
+        不会再被跳板机上的shell或目标主机的cmd解析。
+        """
+        encoded = base64.b64encode(script.encode('utf-16-le')).decode('ascii')
+        return 'powershell -NoProfile -NonInteractive -EncodedCommand ' + encoded
+
+    @staticmethod
+    def decode_compressed_stream(chunks: Iterable[bytes]) -> bytes:
+        """边接收边解码 gzip + Base64 数据，不保留完整的Base64文本"""
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        output = bytearray()
+        pending = b''
+        for chunk in chunks:
+            pending += b''.join(chunk.split())
+            usable = len(pending) - len(pending) % 4
+            output += decompressor.decompress(base64.b64decode(pending[:usable], validate=True))
+            pending = pending[usable:]
+        if pending:
+            raise binascii.Error("Truncated Base64 payload")
+        output += decompressor.flush()
+        if not decompressor.eof:
+            raise EOFError("Compressed payload ended before the end-of-stream marker")
+        return bytes(output)
+
+    @staticmethod
+    def decode_compressed_view(payload: memoryview, chunk_size: int = 65536) -> bytes:
+        """分块解码不含空白的 gzip + Base64 数据（如批量读取的一行），不复制整段Base64"""
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        parts = []
+        chunk_size -= chunk_size % 4
+        for offset in range(0, len(payload), chunk_size):
+            parts.append(decompressor.decompress(base64.b64decode(payload[offset:offset + chunk_size], validate=True)))
+        parts.append(decompressor.flush())
+        if not decompressor.eof:
+            raise EOFError("Compressed payload ended before the end-of-stream marker")
+        return b''.join(parts)
+
+    @staticmethod
+    def decode_compressed_payload(payload: str) -> bytes:
+        """解码远端输出的 gzip + Base64 数据，返回文件原始字节"""
+        # 去掉换行等空白字符（PowerShell输出可能附带CRLF）
+        compact = ''.join(payload.split())
+        return gzip.decompress(base64.b64decode(compact, validate=True))
+
+    def read_file_bytes_via_jumpbox(self,
+                                    jumpbox_host: str,
+                                    jumpbox_username: str,
+                                    jumpbox_password: str,
+                                    target_host: str,
+                                    target_username: str,
+                                    target_password: str,
+                                    file_path: str) -> Tuple[bool, bytes]:
+        """通过跳板机读取文件原始字节
+
+        远端读取文件字节后用gzip压缩并Base64编码输出，本地解码解压，
+        内容与远端文件逐字节一致。
+        """
+        script = (
+            '$p = ' + self.quote_powershell(file_path) + '\n'
+            'if (-not (Test-Path -LiteralPath $p)) { [Console]::Error.WriteLine(\'File not found\'); exit 2 }\n'
+            '$bytes = [System.IO.File]::ReadAllBytes($p)\n'
+            '$ms = New-Object System.IO.MemoryStream\n'
+            '$gz = New-Object System.IO.Compression.GZipStream($ms, [System.IO.Compression.CompressionMode]::Compress)\n'
+            '$gz.Write($bytes, 0, $bytes.Length)\n'
+            '$gz.Close()\n'
+            '[Console]::Out.Write([System.Convert]::ToBase64String($ms.ToArray()))\n'
+        )
+
+        stream = self.stream_command_via_jumpbox(
+            jumpbox_host, jumpbox_username, jumpbox_password,
+            target_host, target_username, target_password,
+            self.build_powershell_command(script), operation='read'
+        )
+        try:
+            data = self.decode_compressed_stream(stream)
+        except (binascii.Error, zlib.error, EOFError) as e:
+            if stream.error is None and stream.exit_code in (None, 0):
+                logger.error(f"Failed to decode file {file_path}: {str(e)}")
+                return False, b''
+            data = b''
+        if not stream.success:
+            logger.error(f"Failed to read file {file_path}: {stream.error or stream.stderr}")
+            return False, b''
+        return True, data
+
     def read_file_via_jumpbox(self,
                               jumpbox_host: str,
                               jumpbox_username: str,
@@ -100,17 +576,21 @@ class SSHConnectionManager:
                               target_username: str,
                               target_password: str,
                               file_path: str) -> Tuple[bool, str]:
-        """通过跳板机读取文件"""
-        # 简化PowerShell命令，避免语法错误
-        ps_command = 'powershell -Command "if (Test-Path \'' + file_path + '\') { Get-Content -Path \'' + file_path + '\' -Raw } else { Write-Error \'File not found\' }"'
-
-        success, result = self.execute_command_via_jumpbox(
+        """通过跳板机读取文件（UTF-8文本）"""
+        success, data = self.read_file_bytes_via_jumpbox(
             jumpbox_host, jumpbox_username, jumpbox_password,
             target_host, target_username, target_password,
-            ps_command
+            file_path
         )
+        if not success:
+            return False, ''
 
-        return success, result
+        try:
+            # utf-8-sig 兼容 PowerShell Set-Content -Encoding UTF8 写入的BOM
+            return True, data.decode('utf-8-sig')
+        except UnicodeDecodeError as e:
+            logger.error(f"File {file_path} is not valid UTF-8: {str(e)}")
+            return False, ''
 
     def write_file_via_jumpbox(self,
                                jumpbox_host: str,
@@ -139,7 +619,6 @@ class SSHConnectionManager:
         # 转义内容中的特殊字符
         # 这里需要特别小心处理Windows PowerShell命令行中的特殊字符
         # 对于复杂的JSON内容，最好使用Base64编码传输
-        import base64
         content_bytes = content.encode('utf-8')
         content_base64 = base64.b64encode(content_bytes).decode('ascii')
 
@@ -162,6 +641,187 @@ class SSHConnectionManager:
         )
         return success
 
+    def read_files_via_jumpbox(self,
+                               jumpbox_host: str,
+                               jumpbox_username: str,
+                               jumpbox_password: str,
+                               target_host: str,
+                               target_username: str,
+                               target_password: str,
+                               file_paths: List[str],
+                               known_hashes: Optional[Dict[str, str]] = None) -> Tuple[bool, Dict[str, dict]]:
+        """通过跳板机在一次远程执行中读取同一主机上的多个文件
+
+        路径和已知哈希经标准输入传输（UTF-8 + Base64，每个文件一行，制表符分隔），
+        不放进 -EncodedCommand，避免文件较多时超出cmd的命令行长度限制（8191字符）。
+        每个文件以独占方式打开（同时完成锁定检查），计算SHA256后gzip + Base64输出，
+        每个文件一行：序号、状态、哈希、数据（制表符分隔）。
+        known_hashes 中哈希未变化的文件只返回状态 unchanged，不传输内容。
+
+        返回 (是否执行成功, {路径: {'status', 'hash', 'data', 'error'}})，
+        status 为 ok / unchanged / locked / missing / error。只有连接或远程执行失败时返回False；
+        单个文件超过 max_line_bytes、输出超出上限等问题只作为对应文件的 error。
+        """
+        known_hashes = known_hashes or {}
+        # Windows路径不能包含制表符和换行符，可直接作为分隔符
+        entries = '\n'.join(path + '\t' + (known_hashes.get(path) or '') for path in file_paths)
+        script = (
+            '$list = [System.Convert]::FromBase64String([Console]::In.ReadToEnd().Trim())\n'
+            '$entries = [System.Text.Encoding]::UTF8.GetString($list).Split([char]10)\n'
+            'for ($i = 0; $i -lt $entries.Count; $i++) {\n'
+            '  $fields = $entries[$i].Split([char]9)\n'
+            '  $p = $fields[0]\n'
+            '  try {\n'
+            '    if (-not (Test-Path -LiteralPath $p)) { [Console]::Out.WriteLine("$i`tMISSING`t`t"); continue }\n'
+            '    $fs = [System.IO.File]::Open($p, \'Open\', \'Read\', \'None\')\n'
+            '    try { $buf = New-Object System.IO.MemoryStream; $fs.CopyTo($buf); $bytes = $buf.ToArray() } finally { $fs.Close() }\n'
+            '    $sha = [System.Security.Cryptography.SHA256]::Create()\n'
+            '    $h = [System.BitConverter]::ToString($sha.ComputeHash($bytes)).Replace(\'-\', \'\').ToLower()\n'
+            '    if ($h -eq $fields[1]) { [Console]::Out.WriteLine("$i`tUNCHANGED`t$h`t"); continue }\n'
+            '    $ms = New-Object System.IO.MemoryStream\n'
+            '    $gz = New-Object System.IO.Compression.GZipStream($ms, [System.IO.Compression.CompressionMode]::Compress)\n'
+            '    $gz.Write($bytes, 0, $bytes.Length)\n'
+            '    $gz.Close()\n'
+            '    [Console]::Out.WriteLine("$i`tOK`t$h`t" + [System.Convert]::ToBase64String($ms.ToArray()))\n'
+            '  } catch [System.IO.IOException] {\n'
+            '    [Console]::Out.WriteLine("$i`tLOCKED`t`t")\n'
+            '  } catch {\n'
+            '    $msg = [System.Convert]::ToBase64String([System.Text.Encoding]::UTF8.GetBytes($_.Exception.Message))\n'
+            '    [Console]::Out.WriteLine("$i`tERROR`t`t$msg")\n'
+            '  }\n'
+            '}\n'
+        )
+
+        stream = self.stream_command_via_jumpbox(
+            jumpbox_host, jumpbox_username, jumpbox_password,
+            target_host, target_username, target_password,
+            self.build_powershell_command(script),
+            input_data=base64.b64encode(entries.encode('utf-8')),
+            operation='read_batch'
+        )
+
+        # 逐行解码，同一时间只保留一个文件的数据；只解析行首的字段，数据部分直接从行内解码
+        results = {}
+
+        def oversized(head: bytes):
+            # 单个文件过大只影响该文件，继续读取其余文件
+            header = self._parse_batch_header(head, len(file_paths))
+            if header is not None:
+                index, _, file_hash, _ = header
+                results[file_paths[index]] = {'status': 'error', 'hash': file_hash or None, 'data': None,
+                                              'error': f"Encoded file exceeds {self.max_line_bytes} bytes"}
+
+        for line in stream.lines(self.max_line_bytes, on_oversized=oversized):
+            header = self._parse_batch_header(line, len(file_paths))
+            if header is None:
+                continue
+            index, status, file_hash, header_end = header
+            result = {'status': status.lower(), 'hash': file_hash or None, 'data': None, 'error': None}
+            with memoryview(line) as view:
+                payload = view[header_end + 1:]
+                try:
+                    if status == 'OK':
+                        result['data'] = self.decode_compressed_view(payload)
+                    elif status == 'ERROR':
+                        result['error'] = base64.b64decode(payload).decode('utf-8', errors='replace')
+                except (binascii.Error, zlib.error, EOFError) as e:
+                    result['status'] = 'error'
+                    result['error'] = f"Failed to decode payload: {str(e)}"
+                payload.release()
+            results[file_paths[index]] = result
+
+        # 只有连接或远程执行失败（没有任何输出）才视为失败；超出输出上限、脚本中途出错等
+        # 只影响未返回结果的文件，避免同一主机上的其他实例被当作离线
+        if not stream.success:
+            message = stream.error or stream.stderr.strip() or f"exit code {stream.exit_code}"
+            if not results and not stream.limit_exceeded:
+                logger.error(f"Failed to read files on {target_host}: {message}")
+                return False, {}
+            logger.warning(f"Incomplete batch read on {target_host}: {message}")
+        else:
+            message = 'No result returned'
+
+        for path in file_paths:
+            if path not in results:
+                results[path] = {'status': 'error', 'hash': None, 'data': None, 'error': message}
+        return True, results
+
+    @staticmethod
+    def _parse_batch_header(line: bytes, count: int) -> Optional[Tuple[int, str, str, int]]:
+        """解析批量读取输出行的行首字段，返回 (序号, 状态, 哈希, 数据起始前的制表符位置)，无效时返回None"""
+        header_end = -1
+        for _ in range(3):
+            header_end = line.find(b'\t', header_end + 1)
+            if header_end < 0:
+                return None
+        index, status, file_hash = line[:header_end].decode('ascii', errors='replace').split('\t')
+        if not index.isdigit() or int(index) >= count:
+            return None
+        return int(index), status, file_hash, header_end
+
+    def write_file_when_unlocked_via_jumpbox(self,
+                                             jumpbox_host: str,
+                                             jumpbox_username: str,
+                                             jumpbox_password: str,
+                                             target_host: str,
+                                             target_username: str,
+                                             target_password: str,
+                                             file_path: str,
+                                             data: bytes,
+                                             wait_timeout: float = 0) -> Tuple[bool, str]:
+        """通过跳板机写入文件，文件被占用时在远端等待释放
+
+        内容以 gzip + Base64 经标准输入传输，远端先写入临时文件，再在 wait_timeout 秒内
+        反复尝试用 File.Replace 替换目标文件（同时保留 .bak 备份），文件一旦释放即写入。
+        整个过程只需一次远程执行。
+
+        返回 (是否写入, 状态)，状态为 written / locked（等待超时）/ error。
+        """
+        script = (
+            '$p = ' + self.quote_powershell(file_path) + '\n'
+            '$tmp = $p + \'.tmp\'\n'
+            '$bak = $p + \'.bak\'\n'
+            '$deadline = (Get-Date).AddSeconds(' + str(float(wait_timeout)) + ')\n'
+            '$compressed = [System.Convert]::FromBase64String([Console]::In.ReadToEnd().Trim())\n'
+            '$in = New-Object System.IO.MemoryStream(,$compressed)\n'
+            '$gz = New-Object System.IO.Compression.GZipStream($in, [System.IO.Compression.CompressionMode]::Decompress)\n'
+            '$out = New-Object System.IO.MemoryStream\n'
+            '$gz.CopyTo($out)\n'
+            '[System.IO.File]::WriteAllBytes($tmp, $out.ToArray())\n'
+            'while ($true) {\n'
+            '  try {\n'
+            '    if (Test-Path -LiteralPath $p) { [System.IO.File]::Replace($tmp, $p, $bak) } else { [System.IO.File]::Move($tmp, $p) }\n'
+            '    [Console]::Out.WriteLine(\'WRITTEN\')\n'
+            '    break\n'
+            '  } catch [System.IO.IOException], [System.UnauthorizedAccessException] {\n'
+            '    if ((Get-Date) -ge $deadline) {\n'
+            '      Remove-Item -LiteralPath $tmp -ErrorAction SilentlyContinue\n'
+            '      [Console]::Out.WriteLine(\'LOCKED\')\n'
+            '      break\n'
+            '    }\n'
+            '    Start-Sleep -Milliseconds 200\n'
+            '  }\n'
+            '}\n'
+        )
+        payload = base64.b64encode(gzip.compress(data))
+
+        success, result = self.execute_command_via_jumpbox(
+            jumpbox_host, jumpbox_username, jumpbox_password,
+            target_host, target_username, target_password,
+            self.build_powershell_command(script),
+            input_data=payload,
+            timeout=self.command_timeout + wait_timeout,
+            operation='write'
+        )
+        if not success:
+            return False, 'error'
+
+        status = result.strip().lower()
+        if status not in ('written', 'locked'):
+            logger.error(f"Unexpected write result for {file_path}: {result.strip()}")
+            return False, 'error'
+        return status == 'written', status
+
     def check_file_locked_via_jumpbox(self,
                                       jumpbox_host: str,
                                       jumpbox_username: str,
@@ -185,7 +845,7 @@ class SSHConnectionManager:
         success, result = self.execute_command_via_jumpbox(
             jumpbox_host, jumpbox_username, jumpbox_password,
             target_host, target_username, target_password,
-            cmd
+            cmd, operation='check_lock'
         )
         if not success:
             # 连接失败默认为锁定
@@ -203,13 +863,15 @@ class SSHConnectionManager:
                 pass
         self.clients.clear()
 
-        for key, client in self.jumpbox_clients.items():
+        with self.lock:
+            jumpbox_clients = list(self.jumpbox_clients.items())
+            self.jumpbox_clients.clear()
+        for key, client in jumpbox_clients:
             try:
                 client.close()
                 logger.info(f"Closed connection to jumpbox {key}")
             except:
                 pass
-        self.jumpbox_clients.clear()
 
 
 class MaaInstance:
@@ -227,34 +889,689 @@ class MaaInstance:
         self.jumpbox_password = jumpbox_password  # 跳板机密码
         self.online = False  # 在线状态
         self.config = {}  # 配置数据
+        self.loaded = False  # 配置是否已从远端成功读取（或成功写入），未加载时config不代表远端文件
         self.last_update = 0  # 最后更新时间
         self.dirty = False  # 是否有本地修改未同步
+        self.remote_hash = None  # 远端文件的SHA256，未知时为None
+        self.lock = threading.RLock()  # 串行化同一实例的远程操作
 
     def __repr__(self):
         return f"MaaInstance(name={self.name}, target={self.target_username}@{self.target_host}, path={self.path}, online={self.online})"
 
 
+class ConfigCache:
+    """实例状态的本地持久化缓存 - 每个实例一个JSON文件（不保存密码）"""
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _file_path(self, name: str) -> str:
+        safe_name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.cache_dir, f"{safe_name}-{digest}.json")
+
+    def load(self, instance: MaaInstance) -> bool:
+        """从缓存恢复实例状态，缓存不存在或与实例定义不符时返回False"""
+        try:
+            with open(self._file_path(instance.name), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable cache for {instance.name}: {str(e)}")
+            return False
+
+        # 主机或路径变化后缓存作废
+        if data.get('target_host') != instance.target_host or data.get('path') != instance.path:
+            return False
+
+        instance.config = data.get('config', {})
+        instance.last_update = data.get('last_update', 0)
+        instance.remote_hash = data.get('remote_hash')
+        instance.dirty = data.get('dirty', False)
+        instance.loaded = data.get('loaded', bool(instance.config))
+        return True
+
+    def save(self, instance: MaaInstance):
+        """保存实例状态（先写临时文件再替换，避免中途退出留下损坏的缓存）"""
+        data = {
+            'name': instance.name,
+            'target_host': instance.target_host,
+            'path': instance.path,
+            'config': instance.config,
+            'last_update': instance.last_update,
+            'remote_hash': instance.remote_hash,
+            'dirty': instance.dirty,
+            'loaded': instance.loaded,
+        }
+        file_path = self._file_path(instance.name)
+        temp_path = f"{file_path}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(temp_path, file_path)
+        except OSError as e:
+            logger.error(f"Failed to save cache for {instance.name}: {str(e)}")
+
+    def delete(self, name: str):
+        """删除实例缓存"""
+        try:
+            os.remove(self._file_path(name))
+        except FileNotFoundError:
+            pass
+
+
+def get_current_profile(config: dict) -> dict:
+    """获取gui.json中当前使用的配置方案，旧版扁平格式直接返回配置本身"""
+    if 'Configurations' not in config:
+        return config
+    current = config.get('Current', 'Default')
+    return config['Configurations'].setdefault(current, {})
+
+
+def get_profile_value(config: dict, key: str, default=''):
+    """读取当前配置方案中的配置项（不修改配置）"""
+    if 'Configurations' not in config:
+        return config.get(key, default)
+    profile = config['Configurations'].get(config.get('Current', 'Default')) or {}
+    return profile.get(key, default)
+
+
+def get_client_region(config: dict) -> str:
+    """获取配置对应的区服"""
+    client_type = get_profile_value(config, CLIENT_TYPE_KEY)
+    return CLIENT_REGIONS.get(client_type, 'Official')
+
+
+def open_stage_policy(stage_manager, preferred: Optional[List[str]] = None,
+                      day_of_week=None) -> Callable[[MaaInstance, dict], Optional[dict]]:
+    """生成按区服分配当日开放关卡的批量修改函数（用于 ConfigManager.apply_to_instances）
+
+    - 指定 preferred 时，设置为其中第一个当日开放的关卡
+    - 否则当前关卡仍开放则保持不变，不开放时优先选择开放的活动关卡，再选择常驻关卡；
+      关卡为空（MAA的"当前/上次"）时保持不变
+    每个区服的开放关卡只查询一次。
+    """
+    open_stages = {}
+    lock = threading.Lock()
+
+    def get_open_stages(region):
+        with lock:
+            if region not in open_stages:
+                open_stages[region] = stage_manager.get_open_stages(day_of_week, client_type=region)
+            return open_stages[region]
+
+    def mutate(instance: MaaInstance, config: dict) -> Optional[dict]:
+        stages = get_open_stages(get_client_region(config))
+        values = [stage['value'] for stage in stages]
+        profile = get_current_profile(config)
+        current = profile.get(STAGE_KEY, '')
+
+        if preferred:
+            candidates = [stage for stage in preferred if stage in values]
+        elif current == '' or current in values:
+            return None
+        else:
+            candidates = ([stage['value'] for stage in stages if 'activity' in stage] +
+                          [stage['value'] for stage in stages if 'activity' not in stage])
+
+        if not candidates or candidates[0] == current:
+            return None
+        profile[STAGE_KEY] = candidates[0]
+        return config
+
+    return mutate
+
+
+class ConfigIndex:
+    """配置二级索引：索引值 -> 实例名集合
+
+    key 为当前配置方案中的配置项名（如 STAGE_KEY），或根据整个配置计算索引值的函数。
+    实例配置变化时调用 update 增量更新，值未变化时不做任何修改。
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.values = {}  # 索引值 -> 实例名集合
+        self.entries = {}  # 实例名 -> 索引值
+
+    def extract(self, config: dict):
+        value = self.key(config) if callable(self.key) else get_profile_value(config, self.key, None)
+        try:
+            hash(value)
+        except TypeError:
+            # 列表、字典等不可哈希的值按JSON文本索引
+            value = json.dumps(value, sort_keys=True, ensure_ascii=False)
+        return value
+
+    def update(self, name: str, config: dict):
+        value = self.extract(config)
+        if name in self.entries and self.entries[name] == value:
+            return
+        self.discard(name)
+        self.entries[name] = value
+        self.values.setdefault(value, set()).add(name)
+
+    def discard(self, name: str):
+        if name not in self.entries:
+            return
+        value = self.entries.pop(name)
+        names = self.values[value]
+        names.discard(name)
+        if not names:
+            del self.values[value]
+
+    def query(self, value) -> set:
+        return set(self.values.get(value, ()))
+
+
+class SyncScheduler:
+    """后台同步调度器
+
+    按实例维护下次到期时间的优先队列（最小堆），到期后执行一次 sync_instance 并重新排期：
+    - 在线且无本地修改：sync_interval 后再检查
+    - 在线但仍有未同步修改（如文件被锁定）：retry_interval 后重试
+    - 离线：从 retry_interval 开始指数退避，最长 max_backoff
+    所有延迟都带随机抖动，避免大量实例同时访问跳板机。
+    同一主机上在 batch_window 秒内到期的实例合并为一批，只执行一次远程读取；
+    同一批实例使用相同的抖动重新排期，下次仍然一起到期。
+    """
+
+    def __init__(self, manager, workers: int = 4, jitter: float = 0.1,
+                 retry_interval: float = 5, max_backoff: float = 600, batch_window: float = 30):
+        self.manager = manager
+        self.workers = workers  # 工作线程数
+        self.jitter = jitter  # 抖动比例（0.1 表示 ±10%）
+        self.retry_interval = retry_interval  # 未同步修改的重试间隔（秒）
+        self.max_backoff = max_backoff  # 离线退避上限（秒）
+        self.batch_window = batch_window  # 同一主机的实例提前合并同步的时间窗口（秒）
+        self.queue = []  # (到期时间, 序号, 实例名)
+        self.due = {}  # 实例名 -> 当前有效的到期时间，堆中其他条目视为过期
+        self.failures = {}  # 实例名 -> 连续离线次数
+        self.in_flight = set()  # 正在同步的实例
+        self.condition = threading.Condition()
+        self.threads = []
+        self.running = False
+        self._counter = itertools.count()
+
+    def _jittered(self, delay: float, factor: Optional[float] = None) -> float:
+        """给延迟加上随机抖动，factor 为None时随机生成"""
+        if delay <= 0:
+            return 0
+        if factor is None:
+            factor = 1 + random.uniform(-self.jitter, self.jitter)
+        return delay * factor
+
+    def schedule(self, name: str, delay: float = 0):
+        """安排实例在 delay 秒后同步，已有更早的安排时保持不变"""
+        due = time.time() + self._jittered(delay)
+        with self.condition:
+            current = self.due.get(name)
+            if current is not None and current <= due:
+                return
+            self.due[name] = due
+            heapq.heappush(self.queue, (due, next(self._counter), name))
+            self.condition.notify()
+
+    def unschedule(self, name: str):
+        """取消实例的同步安排"""
+        with self.condition:
+            self.due.pop(name, None)
+            self.failures.pop(name, None)
+
+    def next_delay(self, name: str) -> Optional[float]:
+        """根据实例当前状态计算下次同步的延迟，实例已移除时返回None"""
+        instance = self.manager.instances.get(name)
+        if instance is None:
+            return None
+
+        if not instance.online:
+            failures = self.failures.get(name, 0) + 1
+            self.failures[name] = failures
+            # 限制指数，避免长期离线时浮点数溢出
+            return min(self.retry_interval * (2 ** min(failures - 1, 30)), self.max_backoff)
+
+        self.failures.pop(name, None)
+        if instance.dirty:
+            return self.retry_interval
+        return self.manager.sync_interval
+
+    def run_once(self, name: str) -> Optional[float]:
+        """同步一个实例并返回下次同步的延迟"""
+        return self.run_batch([name])[name]
+
+    def run_batch(self, names: List[str]) -> Dict[str, Optional[float]]:
+        """同步同一主机上的一批实例，返回 {实例名: 下次同步的延迟}，已移除的实例为None"""
+        present = [name for name in names if name in self.manager.instances]
+        if present:
+            try:
+                self.manager.sync_instances(present)
+            except Exception as e:
+                logger.error(f"Scheduled sync for {', '.join(present)} failed: {str(e)}")
+
+        delays = {}
+        for name in names:
+            if name not in self.manager.instances:
+                delays[name] = None
+                continue
+            try:
+                delays[name] = self.next_delay(name)
+            except Exception as e:
+                logger.error(f"Failed to reschedule {name}: {str(e)}")
+                delays[name] = self.max_backoff
+        return delays
+
+    def _take_same_host(self, name: str, deadline: float) -> List[str]:
+        """取出与 name 同一主机、在 deadline 之前到期的其他实例（调用方持有 condition）"""
+        instance = self.manager.instances.get(name)
+        if instance is None:
+            return []
+        key = self.manager.host_key(instance)
+        batch = []
+        for other, due in list(self.due.items()):
+            if other == name or other in self.in_flight or due > deadline:
+                continue
+            other_instance = self.manager.instances.get(other)
+            if other_instance is not None and self.manager.host_key(other_instance) == key:
+                # 堆中对应的条目与 due 不再一致，之后会被当作过期条目丢弃
+                del self.due[other]
+                batch.append(other)
+        return batch
+
+    def _pop_due(self) -> Optional[List[str]]:
+        """等待并取出下一批到期的实例（同一主机），调度器停止时返回None"""
+        with self.condition:
+            while self.running:
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+
+                due, _, name = self.queue[0]
+                if self.due.get(name) != due:
+                    # 已被更早的安排或取消替代
+                    heapq.heappop(self.queue)
+                    continue
+                if name in self.in_flight:
+                    # 正在同步，完成后会合并这次安排
+                    heapq.heappop(self.queue)
+                    continue
+
+                wait = due - time.time()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+
+                heapq.heappop(self.queue)
+                del self.due[name]
+                batch = [name] + self._take_same_host(name, time.time() + self.batch_window)
+                self.in_flight.update(batch)
+                return batch
+            return None
+
+    def _finish(self, names: List[str], delays: Dict[str, Optional[float]]):
+        """同步完成后重新排期，同一批实例使用相同的抖动"""
+        factor = 1 + random.uniform(-self.jitter, self.jitter)
+        now = time.time()
+        with self.condition:
+            for name in names:
+                self.in_flight.discard(name)
+                requested = self.due.pop(name, None)
+                delay = delays.get(name)
+                if delay is None:
+                    continue
+                due = now + self._jittered(delay, factor)
+                if requested is not None:
+                    # 同步期间有新的安排（如刚产生的本地修改），取较早者
+                    due = min(due, requested)
+                self.due[name] = due
+                heapq.heappush(self.queue, (due, next(self._counter), name))
+            self.condition.notify_all()
+
+    def _worker(self):
+        while True:
+            names = self._pop_due()
+            if names is None:
+                return
+            delays = dict.fromkeys(names, self.max_backoff)
+            try:
+                delays.update(self.run_batch(names))
+            except Exception as e:
+                # 单批实例的异常不能让工作线程退出（否则实例会一直留在 in_flight 中）
+                logger.error(f"Scheduler worker failed on {', '.join(names)}: {str(e)}")
+            finally:
+                self._finish(names, delays)
+
+    def start(self):
+        """启动后台调度线程"""
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"maa-sync-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"Sync scheduler started with {self.workers} workers")
+
+    def stop(self, timeout: Optional[float] = None):
+        """停止后台调度线程（正在进行的同步会执行完）"""
+        with self.condition:
+            if not self.running:
+                return
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+        logger.info("Sync scheduler stopped")
+
+
+class UpdateQueue:
+    """后台配置更新队列 - 提交后立即返回任务ID，由线程池执行"""
+
+    def __init__(self, manager, workers: int = 4, max_jobs: int = 1000):
+        self.manager = manager
+        self.max_jobs = max_jobs  # 保留的任务记录数
+        self.jobs = OrderedDict()  # 任务ID -> 任务状态
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='maa-update')
+
+    def submit(self, instance_name: str, mutate: Callable[[MaaInstance, dict], Optional[dict]],
+               require_loaded: bool = True) -> str:
+        """提交更新任务，mutate、require_loaded 的含义同 ConfigManager.apply_to_instances"""
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'instance': instance_name,
+            'status': 'queued',  # queued / running / done
+            'result': None,  # apply_to_instances 返回的实例报告
+            'created': time.time(),
+            'finished': None,
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        self.executor.submit(self._run, job, mutate, require_loaded)
+        return job_id
+
+    def _run(self, job: dict, mutate: Callable[[MaaInstance, dict], Optional[dict]], require_loaded: bool):
+        job['status'] = 'running'
+        try:
+            job['result'] = self.manager.apply_to_instances(
+                mutate, [job['instance']], require_loaded=require_loaded
+            )[job['instance']]
+        except Exception as e:
+            logger.error(f"Update job {job['id']} failed: {str(e)}")
+            job['result'] = {'status': 'error', 'error': str(e)}
+        job['finished'] = time.time()
+        job['status'] = 'done'
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """获取任务状态的副本"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
 class ConfigManager:
     """MAA配置管理器"""
 
-    def __init__(self):
-        self.ssh_manager = SSHConnectionManager()
+    def __init__(self, cache_dir: Optional[str] = None, slow_operation_threshold: Optional[float] = None,
+                 change_feed=None):
+        self.tracer = SSHTracer(slow_threshold=slow_operation_threshold)  # 远程操作追踪
+        self.ssh_manager = SSHConnectionManager(tracer=self.tracer)
         self.instances = {}
         self.sync_interval = 60  # 配置同步间隔（秒）
+        self.lock_wait_timeout = 10  # 写入时等待配置文件释放的最长时间（秒）
+        self.scheduler = None  # 后台同步调度器
+        self.cache = ConfigCache(cache_dir) if cache_dir else None  # 本地持久化缓存
+        # 线程池在 __init__ 中创建（线程在提交任务时才启动），避免并发请求重复创建
+        self.background = ThreadPoolExecutor(max_workers=4, thread_name_prefix='maa-revalidate')  # 后台校验
+        self.update_queue = UpdateQueue(self)  # 后台更新队列
+        self.change_feed = change_feed  # 变更流（可选），实例在线状态、未同步状态和配置变化时发布事件
+        self.published_state = {}  # 实例名 -> 上次发布的 (online, dirty)
+        self.saved_state = {}  # 实例名 -> 上次写入缓存时的同步状态
+        self.feed_lock = threading.Lock()
+        self.indexes = {}  # 索引名 -> ConfigIndex
+        self.index_lock = threading.Lock()
+        self.add_index('stage', STAGE_KEY)
+        self.add_index('region', get_client_region)
 
     def add_instance(self, name: str, target_host: str, target_username: str,
                      target_password: str, path: str,
-                     jumpbox_host: str, jumpbox_username: str, jumpbox_password: str):
-        """添加MAA实例"""
+                     jumpbox_host: str, jumpbox_username: str, jumpbox_password: str,
+                     refresh: bool = True):
+        """添加MAA实例
+
+        refresh 为False时不立即加载或校验配置（命中缓存时也不校验），
+        可在添加完成后用 sync_all 按主机批量处理。
+        """
         instance = MaaInstance(
             name, target_host, target_username, target_password, path,
             jumpbox_host, jumpbox_username, jumpbox_password
         )
         self.instances[name] = instance
+        self.saved_state.pop(name, None)
+
+        cached = self.cache and self.cache.load(instance)
+        # 同名实例被替换时也需要重建索引项
+        self._index_instance(instance)
+        self._publish_state(instance, 'added')
+        if cached:
+            # 先使用本地缓存，后台通过哈希校验是否需要重新读取（调度器会合并同一主机的实例）
+            logger.info(f"Loaded cached config for {name}")
+            if refresh or self.scheduler:
+                self.revalidate_in_background(name)
+            return instance
+
         # 尝试初始加载配置
-        self.refresh_instance(name)
+        if refresh:
+            self.refresh_instance(name)
+        if self.scheduler:
+            self.scheduler.schedule(name, self.sync_interval)
         return instance
 
+    def revalidate_in_background(self, instance_name: str):
+        """在后台同步实例（推送本地修改或校验远端哈希）"""
+        if self.scheduler:
+            self.scheduler.schedule(instance_name, 0)
+            return
+        self.background.submit(self.sync_instance, instance_name)
+
+    def _instance_changed(self, instance: MaaInstance, config_changed: bool = False):
+        """实例配置或同步状态变化后调用
+
+        config_changed 表示配置内容发生了变化；内容和同步状态都未变化时（如被锁定时的重试）
+        不重写缓存，也不发布事件。
+        """
+        state = (instance.last_update, instance.remote_hash, instance.dirty, instance.loaded)
+        if config_changed:
+            self._index_instance(instance)
+        if self.cache and (config_changed or self.saved_state.get(instance.name) != state):
+            self.cache.save(instance)
+        self.saved_state[instance.name] = state
+        self._publish_state(instance, 'config' if config_changed else None)
+
+    def _publish_state(self, instance: MaaInstance, event_type: Optional[str] = None):
+        """向变更流发布实例事件
+
+        在线状态或未同步状态与上次发布时不同时发布 online / dirty 事件；
+        event_type 指定的事件（added / config / removed）总是发布。
+        """
+        if not self.change_feed:
+            return
+        data = {
+            'online': instance.online,
+            'dirty': instance.dirty,
+            'last_update': instance.last_update,
+            'remote_hash': instance.remote_hash,
+            'stage': get_profile_value(instance.config, STAGE_KEY, None),
+            'region': get_client_region(instance.config) if instance.config else None,
+        }
+        with self.feed_lock:
+            if event_type == 'removed':
+                self.published_state.pop(instance.name, None)
+                self.change_feed.publish('instance', 'removed', instance.name, data)
+                return
+            previous = self.published_state.get(instance.name)
+            self.published_state[instance.name] = (instance.online, instance.dirty)
+            if event_type:
+                self.change_feed.publish('instance', event_type, instance.name, data)
+            if previous is None:
+                return
+            if previous[0] != instance.online:
+                self.change_feed.publish('instance', 'online', instance.name, data)
+            if previous[1] != instance.dirty:
+                self.change_feed.publish('instance', 'dirty', instance.name, data)
+
+    def _index_instance(self, instance: MaaInstance):
+        """增量更新二级索引（尚未加载配置的实例不进入索引）"""
+        with self.index_lock:
+            for index in self.indexes.values():
+                try:
+                    if instance.config:
+                        index.update(instance.name, instance.config)
+                    else:
+                        index.discard(instance.name)
+                except Exception as e:
+                    logger.error(f"Failed to index {instance.name}: {str(e)}")
+                    index.discard(instance.name)
+
+    def add_index(self, name: str, key=None):
+        """添加二级索引并索引现有实例
+
+        key 为当前配置方案中的配置项名（默认与 name 相同），或根据整个配置计算索引值的函数。
+        默认已有 stage（刷理智关卡）和 region（区服）索引。
+        """
+        index = ConfigIndex(key or name)
+        with self.index_lock:
+            for instance in list(self.instances.values()):
+                if instance.config:
+                    index.update(instance.name, instance.config)
+            self.indexes[name] = index
+
+    def query(self, index_name: str, value) -> List[str]:
+        """返回索引值等于 value 的实例名"""
+        with self.index_lock:
+            return sorted(self.indexes[index_name].query(value))
+
+    def index_values(self, index_name: str) -> dict:
+        """返回索引的全部取值：{索引值: [实例名]}"""
+        with self.index_lock:
+            return {value: sorted(names) for value, names in self.indexes[index_name].values.items()}
+
+    def find_stale_stages(self, stage_manager, day_of_week=None) -> Dict[str, dict]:
+        """找出配置了当日未开放关卡的实例
+
+        按区服各查询一次开放关卡，再与 stage 索引交叉比对。关卡为空（MAA的"当前/上次"）
+        的实例不计入；无法获取开放关卡的区服跳过，避免误报。
+        返回 {实例名: {'stage', 'region'}}。
+        """
+        with self.index_lock:
+            regions = {value: set(names) for value, names in self.indexes['region'].values.items()}
+            stages = {value: set(names) for value, names in self.indexes['stage'].values.items() if value}
+
+        stale = {}
+        for region, region_names in regions.items():
+            open_stages = {stage['value'] for stage in stage_manager.get_open_stages(day_of_week, client_type=region)}
+            if not open_stages:
+                logger.warning(f"No open stages for {region}, skipping stale stage check")
+                continue
+            for stage, names in stages.items():
+                if stage in open_stages:
+                    continue
+                for name in names & region_names:
+                    stale[name] = {'stage': stage, 'region': region}
+        return stale
+
+    def load_instances(self, file_path: str, refresh: bool = True) -> List[MaaInstance]:
+        """从JSON文件批量添加实例
+
+        文件内容为列表，每项包含 add_instance 的参数（name、target_host、target_username、
+        target_password、path、jumpbox_host、jumpbox_username、jumpbox_password）。
+        refresh 为True时添加完成后同步全部实例：未命中缓存的实例按主机批量读取，
+        命中缓存的实例在同一次远程执行中按哈希校验，因此重启不会比首次启动多出远程执行。
+        """
+        with open(file_path, 'r', encoding='utf-8') as f:
+            definitions = json.load(f)
+
+        instances = [self.add_instance(refresh=False, **definition) for definition in definitions]
+        if refresh:
+            self.sync_all([instance.name for instance in instances])
+        return instances
+
+    def get_instance_status(self, instance_name: str, include_config: bool = False) -> Optional[dict]:
+        """从内存缓存获取实例状态（不访问远端），实例不存在时返回None
+
+        age 为距上次成功同步的秒数，stale 表示超过 sync_interval 未同步。
+        """
+        instance = self.instances.get(instance_name)
+        if instance is None:
+            return None
+
+        age = time.time() - instance.last_update if instance.last_update else None
+        status = {
+            'name': instance.name,
+            'target_host': instance.target_host,
+            'path': instance.path,
+            'online': instance.online,
+            'dirty': instance.dirty,
+            'loaded': instance.loaded,
+            'last_update': instance.last_update or None,
+            'age': age,
+            'stale': age is None or age > self.sync_interval,
+        }
+        if include_config:
+            status['config'] = instance.config
+        return status
+
+    def queue_update(self, instance_name: str, mutate: Callable[[MaaInstance, dict], Optional[dict]],
+                     require_loaded: bool = True) -> str:
+        """提交后台更新任务，立即返回任务ID"""
+        return self.update_queue.submit(instance_name, mutate, require_loaded)
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        """获取后台更新任务状态"""
+        return self.update_queue.get(job_id)
+
+    def remove_instance(self, name: str) -> bool:
+        """移除MAA实例"""
+        instance = self.instances.pop(name, None)
+        if instance is None:
+            return False
+        self._publish_state(instance, 'removed')
+        self.saved_state.pop(name, None)
+        with self.index_lock:
+            for index in self.indexes.values():
+                index.discard(name)
+        if self.scheduler:
+            self.scheduler.unschedule(name)
+        if self.cache:
+            self.cache.delete(name)
+        return True
+
+    def check_online(self, instance_name: str) -> bool:
+        """测试实例连接并更新在线状态（不读取配置）"""
+        if instance_name not in self.instances:
+            logger.error(f"Instance {instance_name} not found")
+            return False
+
+        instance = self.instances[instance_name]
+        with self.tracer.context(instance=instance_name):
+            success, _ = self.ssh_manager.execute_command_via_jumpbox(
+                instance.jumpbox_host, instance.jumpbox_username, instance.jumpbox_password,
+                instance.target_host, instance.target_username, instance.target_password,
+                'echo "Connection test"', operation='check_online'
+            )
+        instance.online = success
+        self._publish_state(instance)
+        return success
+
     def refresh_instance(self, instance_name: str) -> bool:
         """刷新实例配置"""
         if instance_name not in self.instances:
@@ -262,129 +1579,383 @@ class ConfigManager:
             return False
 
         instance = self.instances[instance_name]
+        with instance.lock:
+            return self._refresh_instance(instance)
 
-        # 检查连接
-        success, result = self.ssh_manager.execute_command_via_jumpbox(
-            instance.jumpbox_host, instance.jumpbox_username, instance.jumpbox_password,
-            instance.target_host, instance.target_username, instance.target_password,
-            'echo "Connection test"'
-        )
-        instance.online = success
+    def _refresh_instance(self, instance: MaaInstance) -> bool:
+        return self._refresh_group([instance])[instance.name]
 
-        if not success:
-            logger.warning(f"Instance {instance_name} is offline")
-            return False
+    def _refresh_group(self, instances: List[MaaInstance], revalidate: bool = False) -> Dict[str, bool]:
+        """在一次远程执行中刷新同一主机上的多个实例
 
-        # 检查文件是否被锁定
-        is_locked = self.ssh_manager.check_file_locked_via_jumpbox(
-            instance.jumpbox_host, instance.jumpbox_username, instance.jumpbox_password,
-            instance.target_host, instance.target_username, instance.target_password,
-            instance.path
-        )
+        revalidate 为True时附带已知哈希，远端文件未变化的实例只更新检查时间；
+        有未同步本地修改的实例不读取（返回False），留给 sync_instance 推送。
+        """
+        with contextlib.ExitStack() as stack:
+            for instance in sorted(instances, key=lambda item: item.name):
+                stack.enter_context(instance.lock)
 
-        if is_locked:
-            logger.warning(f"Config file for {instance_name} is locked")
-            return False
+            outcome = {}
+            if revalidate:
+                # 在持有锁之后检查：调用方判断过期之后、取得锁之前可能产生了本地修改，不能用远端配置覆盖
+                outcome = {instance.name: False for instance in instances if instance.dirty}
+                instances = [instance for instance in instances if not instance.dirty]
+                if not instances:
+                    return outcome
 
-        # 读取配置文件
-        success, content = self.ssh_manager.read_file_via_jumpbox(
-            instance.jumpbox_host, instance.jumpbox_username, instance.jumpbox_password,
-            instance.target_host, instance.target_username, instance.target_password,
-            instance.path
-        )
+            first = instances[0]
+            paths = [instance.path for instance in instances]
+            known_hashes = {instance.path: instance.remote_hash for instance in instances
+                            if revalidate and instance.remote_hash}
 
-        if not success:
-            logger.error(f"Failed to read config for {instance_name}")
-            return False
+            with self.tracer.context(instance=','.join(instance.name for instance in instances)):
+                success, results = self.ssh_manager.read_files_via_jumpbox(
+                    first.jumpbox_host, first.jumpbox_username, first.jumpbox_password,
+                    first.target_host, first.target_username, first.target_password,
+                    paths, known_hashes
+                )
 
-        try:
-            # 清理内容中的控制字符
-            import re
-            # 移除或替换可能导致JSON解析失败的控制字符
-            cleaned_content = re.sub(r'[\x00-\x1F\x7F-\x9F]', '', content)
+            for instance in instances:
+                instance.online = success
+                if not success:
+                    logger.warning(f"Instance {instance.name} is offline")
+                    outcome[instance.name] = False
+                else:
+                    outcome[instance.name] = self._apply_read_result(instance, results[instance.path])
+                self._publish_state(instance)
+            return outcome
 
-            # 尝试解析JSON
-            config = json.loads(cleaned_content)
-            instance.config = config
+    def _apply_read_result(self, instance: MaaInstance, result: dict) -> bool:
+        """根据远端读取结果更新实例"""
+        instance_name = instance.name
+        status = result['status']
+
+        if status == 'unchanged':
             instance.last_update = time.time()
-            instance.dirty = False
-            logger.info(f"Successfully refreshed config for {instance_name}")
+            self._instance_changed(instance)
             return True
-        except json.JSONDecodeError as e:
+
+        if status == 'locked':
+            logger.warning(f"Config file for {instance_name} is locked")
+            return False
+
+        if status != 'ok':
+            logger.error(f"Failed to read config for {instance_name}: {result['error'] or status}")
+            return False
+
+        try:
+            # 内容与远端文件逐字节一致，直接解析JSON
+            config = json.loads(result['data'].decode('utf-8-sig'))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            # 可能读到了MAA写入一半的文件：保留上次成功读取的配置，清除哈希使下次校验重新读取
             logger.error(f"Failed to parse config for {instance_name}: {str(e)}")
+            instance.remote_hash = None
+            self._instance_changed(instance)
+            return False
 
-            # 如果仍然无法解析，我们可以尝试简单地返回一个空配置，这样至少测试可以通过
-            logger.warning(f"Using empty config for {instance_name} due to parse error")
-            instance.config = {}
-            instance.last_update = time.time()
-            instance.dirty = False
-            return True  # 返回True以便测试可以继续
+        config_changed = config != instance.config
+        instance.config = config
+        instance.remote_hash = result['hash']
+        instance.loaded = True
+        instance.last_update = time.time()
+        instance.dirty = False
+        logger.info(f"Successfully refreshed config for {instance_name}")
+        self._instance_changed(instance, config_changed)
+        return True
+
+    def refresh_all(self, instance_names: Optional[Iterable[str]] = None, revalidate: bool = False,
+                    max_workers: int = 8) -> Dict[str, bool]:
+        """按主机分组刷新实例，每台主机只执行一次远程读取"""
+        return self._run_per_host(self.group_by_host(instance_names),
+                                  lambda key, instances: self._refresh_group(instances, revalidate),
+                                  max_workers)
+
+    def revalidate_instance(self, instance_name: str) -> bool:
+        """校验实例配置是否过期：远端哈希未变时只更新时间，否则重新读取"""
+        if instance_name not in self.instances:
+            logger.error(f"Instance {instance_name} not found")
+            return False
+
+        instance = self.instances[instance_name]
+        with instance.lock:
+            return self._revalidate_instance(instance)
+
+    def _revalidate_instance(self, instance: MaaInstance) -> bool:
+        return self._refresh_group([instance], revalidate=True)[instance.name]
+
+    def update_config(self, instance_name: str, config: dict, wait_for_unlock: Optional[float] = None) -> bool:
+        """更新实例配置
 
-    def update_config(self, instance_name: str, config: dict) -> bool:
-        """更新实例配置"""
+        配置文件被占用时在远端最多等待 wait_for_unlock 秒（默认 lock_wait_timeout），
+        为0时不等待。
+        """
         if instance_name not in self.instances:
             logger.error(f"Instance {instance_name} not found")
             return False
 
         instance = self.instances[instance_name]
+        with instance.lock:
+            success = self._update_config(instance, config, wait_for_unlock)
+        self._schedule_retry(instance)
+        return success
+
+    def _schedule_retry(self, instance: MaaInstance):
+        """未能同步的修改尽快重试"""
+        if instance.dirty and self.scheduler:
+            self.scheduler.schedule(instance.name, self.scheduler.retry_interval)
+
+    def _update_config(self, instance: MaaInstance, config: dict, wait_for_unlock: Optional[float] = None) -> bool:
+        instance_name = instance.name
+        if wait_for_unlock is None:
+            wait_for_unlock = self.lock_wait_timeout
+        # 重试推送未同步的修改时配置内容不变，不发布 config 事件
+        config_changed = config != instance.config
 
         # 如果实例离线，只更新本地配置
         if not instance.online:
             instance.config = config
             instance.dirty = True
             logger.info(f"Instance {instance_name} is offline, config changes will be synced later")
+            self._instance_changed(instance, config_changed)
             return True
 
-        # 检查文件是否被锁定
-        is_locked = self.ssh_manager.check_file_locked_via_jumpbox(
-            instance.jumpbox_host, instance.jumpbox_username, instance.jumpbox_password,
-            instance.target_host, instance.target_username, instance.target_password,
-            instance.path
-        )
-
-        if is_locked:
-            logger.warning(f"Config file for {instance_name} is locked, changes will be synced later")
-            instance.config = config
-            instance.dirty = True
-            return False
-
-        # 写入配置
+        # 写入配置（文件被锁定时在远端等待释放）
         try:
-            content = json.dumps(config, indent=2, ensure_ascii=False)
-            success = self.ssh_manager.write_file_via_jumpbox(
-                instance.jumpbox_host, instance.jumpbox_username, instance.jumpbox_password,
-                instance.target_host, instance.target_username, instance.target_password,
-                instance.path, content
-            )
+            data = json.dumps(config, indent=2, ensure_ascii=False).encode('utf-8')
+            with self.tracer.context(instance=instance_name):
+                success, status = self.ssh_manager.write_file_when_unlocked_via_jumpbox(
+                    instance.jumpbox_host, instance.jumpbox_username, instance.jumpbox_password,
+                    instance.target_host, instance.target_username, instance.target_password,
+                    instance.path, data, wait_for_unlock
+                )
 
+            instance.config = config
             if success:
-                instance.config = config
                 instance.last_update = time.time()
                 instance.dirty = False
+                instance.loaded = True
+                # 写入的字节与本地一致，可直接记录哈希
+                instance.remote_hash = hashlib.sha256(data).hexdigest()
                 logger.info(f"Successfully updated config for {instance_name}")
-                return True
+            elif status == 'locked':
+                logger.warning(f"Config file for {instance_name} is locked, changes will be synced later")
+                instance.dirty = True
             else:
                 logger.error(f"Failed to write config for {instance_name}")
-                instance.config = config
                 instance.dirty = True
-                return False
+            self._instance_changed(instance, config_changed)
+            if not success and status != 'locked':
+                # 连接或远程执行失败时重新检测在线状态，离线后由调度器指数退避而不是按 retry_interval 重试
+                self.check_online(instance_name)
+            return success
         except Exception as e:
             logger.error(f"Error updating config for {instance_name}: {str(e)}")
             instance.config = config
             instance.dirty = True
+            self._instance_changed(instance, config_changed)
+            self.check_online(instance_name)
+            return False
+
+    def sync_instance(self, instance_name: str) -> bool:
+        """同步单个实例：推送本地修改，或在配置过期时刷新"""
+        if instance_name not in self.instances:
+            logger.error(f"Instance {instance_name} not found")
             return False
 
-    def sync_all(self):
-        """同步所有实例配置"""
-        for name, instance in self.instances.items():
-            # 如果有本地修改且实例在线，尝试同步
+        instance = self.instances[instance_name]
+        with instance.lock:
+            # 如果有本地修改，确认在线后推送（不能先刷新，否则会覆盖本地修改）
+            if instance.dirty:
+                if instance.online or self.check_online(instance_name):
+                    return self._update_config(instance, instance.config)
+                return False
+            # 如果长时间未更新或离线，校验并刷新配置
+            if not instance.online or time.time() - instance.last_update > self.sync_interval:
+                return self._revalidate_instance(instance)
+            return True
+
+    def sync_instances(self, instance_names: Iterable[str]) -> Dict[str, bool]:
+        """同步同一主机上的多个实例（调度器合并到期的实例时使用）
+
+        有本地修改的实例逐个推送；其余实例只要有一个离线或过期，就在一次远程执行中一起校验。
+        """
+        results = {}
+        clean = []
+        for name in instance_names:
+            instance = self.instances.get(name)
+            if instance is None:
+                continue
+            if instance.dirty:
+                results[name] = self.sync_instance(name)
+            else:
+                clean.append(instance)
+        if not clean:
+            return results
+
+        with contextlib.ExitStack() as stack:
+            for instance in sorted(clean, key=lambda item: item.name):
+                stack.enter_context(instance.lock)
+            # 等待锁期间产生了本地修改的实例由 _refresh_group 跳过
+            now = time.time()
+            if any(not instance.online or now - instance.last_update > self.sync_interval for instance in clean):
+                results.update(self._refresh_group(clean, revalidate=True))
+            else:
+                results.update({instance.name: True for instance in clean})
+        return results
+
+    def sync_all(self, instance_names: Optional[Iterable[str]] = None, max_workers: int = 8):
+        """同步实例配置：逐个推送本地修改，过期的实例按主机分组批量校验
+
+        instance_names 为None时同步全部实例。
+        """
+        if instance_names is None:
+            instance_names = list(self.instances)
+        stale = []
+        for name in instance_names:
+            instance = self.instances.get(name)
+            if instance is None:
+                continue
             if instance.dirty:
-                if instance.online or self.refresh_instance(name):  # 刷新状态或确认在线
-                    self.update_config(name, instance.config)
-            # 如果长时间未更新，刷新配置
-            elif time.time() - instance.last_update > self.sync_interval:
-                self.refresh_instance(name)
+                self.sync_instance(name)
+            elif not instance.online or time.time() - instance.last_update > self.sync_interval:
+                stale.append(name)
+        if stale:
+            self.refresh_all(stale, revalidate=True, max_workers=max_workers)
+
+    @staticmethod
+    def host_key(instance: MaaInstance) -> Tuple[str, str, str, str]:
+        """实例所在主机的分组键 (跳板机, 跳板机用户, 目标主机, 目标主机用户)"""
+        return (instance.jumpbox_host, instance.jumpbox_username,
+                instance.target_host, instance.target_username)
+
+    def group_by_host(self, instance_names: Optional[Iterable[str]] = None) -> Dict[Tuple[str, str, str, str], List[MaaInstance]]:
+        """按主机分组实例，instance_names 为None时包含全部实例"""
+        if instance_names is None:
+            instance_names = list(self.instances)
+        groups = {}
+        for name in instance_names:
+            instance = self.instances.get(name)
+            if instance is not None:
+                groups.setdefault(self.host_key(instance), []).append(instance)
+        return groups
+
+    @staticmethod
+    def _run_per_host(groups: Dict[Tuple[str, str, str, str], List[MaaInstance]],
+                      func: Callable[[Tuple[str, str, str, str], List[MaaInstance]], dict],
+                      max_workers: int = 8, max_per_jumpbox: int = 4) -> dict:
+        """对每台主机的实例组并行执行 func(key, instances)，合并返回的字典
+
+        同一跳板机的并发数不超过 max_per_jumpbox。
+        """
+        jumpbox_slots = {}
+        for key in groups:
+            jumpbox_slots.setdefault(key[:2], threading.Semaphore(max_per_jumpbox))
+
+        def run_group(key, instances):
+            with jumpbox_slots[key[:2]]:
+                return func(key, instances)
+
+        results = {}
+        if not groups:
+            return results
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(run_group, key, instances) for key, instances in groups.items()]
+            for future in futures:
+                results.update(future.result())
+        return results
+
+    def _apply_to_instance(self, instance: MaaInstance,
+                           mutate: Callable[[MaaInstance, dict], Optional[dict]],
+                           require_loaded: bool = True) -> dict:
+        """对单个实例执行修改函数并写入，返回结果报告"""
+        start = time.time()
+        report = {'status': 'unchanged', 'error': None}
+        try:
+            with instance.lock:
+                if require_loaded and not instance.loaded:
+                    # 未读取过远端配置时本地config为空，修改后写回会覆盖整个远端文件
+                    report['status'] = 'not_loaded'
+                    report['error'] = 'Config has not been loaded'
+                    report['online'] = instance.online
+                    report['elapsed'] = time.time() - start
+                    return report
+                config = mutate(instance, copy.deepcopy(instance.config))
+                if config is not None and config != instance.config:
+                    success = self._update_config(instance, config)
+                    if success and not instance.dirty:
+                        report['status'] = 'updated'
+                    else:
+                        # 离线、被锁定或写入失败，修改已保存在本地等待同步
+                        report['status'] = 'pending'
+            self._schedule_retry(instance)
+        except Exception as e:
+            logger.error(f"Failed to apply changes to {instance.name}: {str(e)}")
+            report['status'] = 'error'
+            report['error'] = str(e)
+        report['online'] = instance.online
+        report['elapsed'] = time.time() - start
+        return report
+
+    def apply_to_instances(self, mutate: Callable[[MaaInstance, dict], Optional[dict]],
+                           instance_names: Optional[Iterable[str]] = None,
+                           max_workers: int = 8, max_per_jumpbox: int = 4,
+                           require_loaded: bool = True) -> Dict[str, dict]:
+        """批量修改实例配置
+
+        mutate(instance, config) 接收配置的副本，返回新配置；返回None表示不修改。
+        require_loaded 为True时跳过从未成功读取配置的实例（mutate 返回完整配置时可设为False）。
+        同一主机上的实例串行写入，不同主机并行，同一跳板机的并发数不超过 max_per_jumpbox。
+        返回 {实例名: {'status', 'error', 'online', 'elapsed'}}，
+        status 为 updated / unchanged / pending（已保存在本地等待同步）/ not_loaded / error / not_found。
+        """
+        if instance_names is None:
+            instance_names = list(self.instances)
+        instance_names = list(instance_names)
+        results = {name: {'status': 'not_found', 'error': 'Instance not found'}
+                   for name in instance_names if name not in self.instances}
+
+        groups = self.group_by_host(instance_names)
+        results.update(self._run_per_host(
+            groups,
+            lambda key, instances: {instance.name: self._apply_to_instance(instance, mutate, require_loaded)
+                                    for instance in instances},
+            max_workers, max_per_jumpbox
+        ))
+
+        updated = sum(1 for result in results.values() if result['status'] == 'updated')
+        logger.info(f"Applied changes to {len(results)} instances across {len(groups)} hosts, {updated} updated")
+        return results
+
+    def get_ssh_stats(self, reset: bool = False) -> dict:
+        """远程操作统计：总往返次数、按目标主机的延迟直方图和字节数、按跳板机的连接计数"""
+        stats = self.tracer.snapshot()
+        if reset:
+            self.tracer.reset()
+        return stats
+
+    def start_scheduler(self, **kwargs) -> SyncScheduler:
+        """启动后台同步调度器，参数同 SyncScheduler"""
+        if self.scheduler is None:
+            self.scheduler = SyncScheduler(self, **kwargs)
+        offsets = {}
+        for name, instance in list(self.instances.items()):
+            # 从未加载过或尚未确认在线（如刚从缓存加载）的实例立即同步，
+            # 其余按主机在一个同步周期内随机分散（同一主机的实例一起到期）
+            offset = offsets.setdefault(self.host_key(instance), random.uniform(0, self.sync_interval))
+            delay = 0 if instance.last_update == 0 or not instance.online else offset
+            self.scheduler.schedule(name, delay)
+        self.scheduler.start()
+        return self.scheduler
+
+    def stop_scheduler(self, timeout: Optional[float] = None):
+        """停止后台同步调度器"""
+        if self.scheduler:
+            self.scheduler.stop(timeout)
+            self.scheduler = None
 
     def close(self):
         """关闭管理器"""
-        self.ssh_manager.close_all()
\ No newline at end of file
+        self.stop_scheduler()
+        self.update_queue.shutdown()
+        self.background.shutdown(wait=True)
+        self.ssh_manager.close_all()
@@ -1,17 +1,23 @@
 import requests
 import json
 import os
+import threading
 from datetime import datetime, timedelta
 import time
 
 
 class StageDataManager:
-    def __init__(self, cache_dir='./cache'):
+    def __init__(self, cache_dir='./cache', change_feed=None):
         self.base_url = 'https://ota.maa.plus/MaaAssistantArknights/api/'  # MAA API基础URL
         self.cache_dir = cache_dir
-        self.cached_stage_data = None
-        self.cached_stage_data_time = 0
+        self.cached_stage_data = {}  # 客户端类型 -> 关卡数据
+        self.cached_stage_data_time = {}  # 客户端类型 -> 缓存时间
         self.cache_lifespan = 24 * 60 * 60  # 24小时，单位秒
+        self.change_feed = change_feed  # 变更流（可选），关卡数据更新和开放关卡变化时发布事件
+        self.open_stage_values = {}  # 客户端类型 -> 上次检查时当日开放的关卡
+        self.lock = threading.Lock()
+        self.watcher = None
+        self.watcher_stop = threading.Event()
 
         # 确保缓存目录存在
         os.makedirs(self.cache_dir, exist_ok=True)
@@ -21,8 +27,8 @@ class StageDataManager:
     def get_stage_data(self, client_type='Official', force_refresh=False):
         """获取关卡数据，优先使用缓存"""
         # 检查缓存是否有效
-        if not force_refresh and self.is_cache_valid():
-            return self.cached_stage_data
+        if not force_refresh and self.is_cache_valid(client_type):
+            return self.cached_stage_data[client_type]
 
         try:
             # 获取活动关卡数据
@@ -35,8 +41,11 @@ class StageDataManager:
             stage_data = self.parse_stage_data(activity_data, tasks_data, client_type)
 
             # 更新缓存
-            self.cached_stage_data = stage_data
-            self.cached_stage_data_time = time.time()
+            previous = self.cached_stage_data.get(client_type)
+            self.cached_stage_data[client_type] = stage_data
+            self.cached_stage_data_time[client_type] = time.time()
+            if self.change_feed and stage_data != previous:
+                self.change_feed.publish('stages', 'stage_data', client_type, {'stages': stage_data})
 
             return stage_data
         except Exception as e:
@@ -44,10 +53,10 @@ class StageDataManager:
             # 尝试从本地缓存文件加载
             return self.load_from_local_cache(client_type)
 
-    def is_cache_valid(self):
+    def is_cache_valid(self, client_type='Official'):
         """判断缓存是否仍然有效"""
-        return (self.cached_stage_data is not None and
-                (time.time() - self.cached_stage_data_time < self.cache_lifespan))
+        return (client_type in self.cached_stage_data and
+                (time.time() - self.cached_stage_data_time.get(client_type, 0) < self.cache_lifespan))
 
     def fetch_api_with_cache(self, api_path):
         """从API获取数据并缓存到本地文件"""
@@ -215,26 +224,67 @@ class StageDataManager:
 
         return current_day_of_week in stage['openDays']
 
-    def get_open_stages(self, day_of_week=None):
+    def get_open_stages(self, day_of_week=None, client_type='Official'):
         """获取开放关卡列表"""
+        today = day_of_week is None
         if day_of_week is None:
             # 注意：Python的weekday()返回0-6，对应周一到周日
             # 转换为0-6对应周日到周六
             current_weekday = datetime.now().weekday()
             day_of_week = 6 if current_weekday == 6 else current_weekday + 1
 
-        if not self.cached_stage_data:
-            self.get_stage_data()
+        stage_data = self.get_stage_data(client_type)
 
         all_stages = []
 
         # 添加常驻关卡
-        if 'permanent' in self.cached_stage_data:
-            all_stages.extend(self.cached_stage_data['permanent'])
+        if 'permanent' in stage_data:
+            all_stages.extend(stage_data['permanent'])
 
         # 添加活动关卡
-        if 'activity' in self.cached_stage_data:
-            all_stages.extend(self.cached_stage_data['activity'])
+        if 'activity' in stage_data:
+            all_stages.extend(stage_data['activity'])
 
         # 过滤出开放的关卡
-        return [stage for stage in all_stages if self.is_stage_open(stage, day_of_week)]
\ No newline at end of file
+        open_stages = [stage for stage in all_stages if self.is_stage_open(stage, day_of_week)]
+        if today:
+            self.track_open_stages(client_type, open_stages)
+        return open_stages
+
+    def track_open_stages(self, client_type, open_stages):
+        """记录当日开放关卡，与上次相比有关卡开放或关闭时发布事件"""
+        values = {stage['value'] for stage in open_stages}
+        with self.lock:
+            previous = self.open_stage_values.get(client_type)
+            self.open_stage_values[client_type] = values
+        if previous is None or previous == values or not self.change_feed:
+            return
+        self.change_feed.publish('stages', 'open_stages', client_type, {
+            'opened': sorted(values - previous),
+            'closed': sorted(previous - values),
+            'open': sorted(values),
+        })
+
+    def start_watcher(self, interval=60):
+        """后台定期检查已查询过的客户端类型的开放关卡（活动开始/结束、跨天）"""
+        if self.watcher:
+            return
+
+        def run():
+            while not self.watcher_stop.wait(interval):
+                for client_type in list(self.cached_stage_data):
+                    try:
+                        self.get_open_stages(client_type=client_type)
+                    except Exception as e:
+                        print(f"Error checking open stages for {client_type}: {e}")
+
+        self.watcher_stop.clear()
+        self.watcher = threading.Thread(target=run, name='stage-watcher', daemon=True)
+        self.watcher.start()
+
+    def stop_watcher(self):
+        """停止后台检查"""
+        if self.watcher:
+            self.watcher_stop.set()
+            self.watcher.join()
+            self.watcher = None
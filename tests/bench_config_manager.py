@@ -0,0 +1,103 @@
+"""config_manager 往返次数基准测试（使用本地模拟跳板机，不需要真实主机）
+
+用法：
+    python tests/bench_config_manager.py --hosts 1,5,20 --instances-per-host 2 --latency 0.02 --file-size 30000
+
+对每个模拟集群规模分别测量 refresh（逐个实例）、refresh_all（按主机批量）、
+update（apply_to_instances）和 sync_all（全部过期，哈希校验），
+输出远程执行次数、传输字节数和耗时。
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from config_manager import ConfigManager, STAGE_KEY, get_current_profile
+from fake_jumpbox import FakeJumpbox, make_gui_config, json_bytes
+
+
+def build_fleet(jumpbox: FakeJumpbox, manager: ConfigManager, hosts: int, instances_per_host: int,
+                file_size: int, latency: float):
+    """在模拟跳板机上创建 hosts 台目标主机，每台 instances_per_host 个MAA配置"""
+    for host_index in range(hosts):
+        host = f"10.0.{host_index // 250}.{host_index % 250 + 1}"
+        target = jumpbox.add_target(host, latency=latency)
+        for instance_index in range(instances_per_host):
+            path = f"C:\\Users\\maa\\Desktop\\maa{instance_index}\\config\\gui.json"
+            target.set_file(path, json_bytes(make_gui_config(file_size)))
+            manager.add_instance(
+                f"maa-{host_index}-{instance_index}", host, target.username, target.password, path,
+                jumpbox.address, jumpbox.username, jumpbox.password, refresh=False
+            )
+
+
+def measure(jumpbox: FakeJumpbox, name: str, func) -> dict:
+    jumpbox.stats.reset()
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    stats = jumpbox.stats.snapshot()
+    return {
+        'operation': name,
+        'round_trips': stats['round_trips'],
+        'bytes': stats['bytes_in'] + stats['bytes_out'],
+        'seconds': elapsed,
+    }
+
+
+def run_fleet(hosts: int, instances_per_host: int, file_size: int, latency: float, workers: int) -> list:
+    jumpbox = FakeJumpbox(latency=latency).start()
+    manager = ConfigManager()
+    try:
+        build_fleet(jumpbox, manager, hosts, instances_per_host, file_size, latency)
+        names = list(manager.instances)
+
+        def refresh_each():
+            for name in names:
+                manager.refresh_instance(name)
+
+        def set_stage(instance, config):
+            get_current_profile(config)[STAGE_KEY] = 'CE-6'
+            return config
+
+        def sync_stale():
+            for instance in manager.instances.values():
+                instance.last_update = 0
+            manager.sync_all(max_workers=workers)
+
+        return [
+            measure(jumpbox, 'refresh', refresh_each),
+            measure(jumpbox, 'refresh_all', lambda: manager.refresh_all(max_workers=workers)),
+            measure(jumpbox, 'update', lambda: manager.apply_to_instances(set_stage, max_workers=workers)),
+            measure(jumpbox, 'sync_all', sync_stale),
+        ]
+    finally:
+        manager.close()
+        jumpbox.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark config_manager against a local fake jumpbox')
+    parser.add_argument('--hosts', default='1,5,20', help='逗号分隔的目标主机数量')
+    parser.add_argument('--instances-per-host', type=int, default=2)
+    parser.add_argument('--file-size', type=int, default=30000, help='gui.json 大小（字节）')
+    parser.add_argument('--latency', type=float, default=0.02, help='跳板机和目标主机各自的单次执行延迟（秒）')
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    logging.getLogger('config_manager').setLevel(logging.WARNING)
+    logging.getLogger('paramiko').setLevel(logging.WARNING)
+
+    print(f"{'hosts':>5} {'instances':>9} {'operation':<12} {'round trips':>11} {'bytes':>10} {'seconds':>8}")
+    for hosts in [int(value) for value in args.hosts.split(',')]:
+        for result in run_fleet(hosts, args.instances_per_host, args.file_size, args.latency, args.workers):
+            print(f"{hosts:>5} {hosts * args.instances_per_host:>9} {result['operation']:<12} "
+                  f"{result['round_trips']:>11} {result['bytes']:>10} {result['seconds']:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+"""本地模拟的跳板机/目标主机，用于离线测试和基准测试 config_manager
+
+FakeJumpbox 基于 paramiko 的服务端接口在本机端口上提供SSH服务，解析
+SSHConnectionManager 发出的 sshpass 跳转命令，并模拟其使用的 PowerShell 脚本
+（连接测试、单文件读取、批量读取、等待解锁写入）。目标主机由 FakeTarget 表示，
+文件保存在内存中，可配置延迟、离线和文件锁定。
+"""
+import re
+import gzip
+import json
+import time
+import base64
+import socket
+import hashlib
+import logging
+import threading
+import paramiko
+
+logger = logging.getLogger(__name__)
+
+_host_key = None
+_host_key_lock = threading.Lock()
+
+
+def get_host_key() -> paramiko.RSAKey:
+    """生成并缓存服务端主机密钥（生成较慢，整个进程共用一个）"""
+    global _host_key
+    with _host_key_lock:
+        if _host_key is None:
+            _host_key = paramiko.RSAKey.generate(2048)
+        return _host_key
+
+
+def make_gui_config(size: int, stage: str = '1-7', client_type: str = 'Official') -> dict:
+    """生成大约 size 字节的 gui.json 配置"""
+    profile = {
+        'MainFunction.Stage1': stage,
+        'Start.ClientType': client_type,
+    }
+    config = {'Current': 'Default', 'Configurations': {'Default': profile}, 'Global': {}}
+    index = 0
+    while len(json_bytes(config)) < size:
+        profile[f'Padding.Item{index}'] = 'x' * 64
+        index += 1
+    return config
+
+
+def json_bytes(config: dict) -> bytes:
+    return json.dumps(config, indent=2, ensure_ascii=False).encode('utf-8')
+
+
+class FakeTarget:
+    """模拟的Windows目标主机"""
+
+    def __init__(self, host: str, username: str = 'maa', password: str = 'maa', latency: float = 0):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.latency = latency  # 每次远程执行的额外延迟（秒）
+        self.online = True
+        self.files = {}  # 路径 -> 文件字节
+        self.locks = {}  # 路径 -> 锁定截止时间（None 表示一直锁定）
+        self.lock = threading.Lock()
+
+    def set_file(self, path: str, data: bytes):
+        with self.lock:
+            self.files[path] = data
+
+    def get_file(self, path: str) -> bytes:
+        with self.lock:
+            return self.files[path]
+
+    def lock_file(self, path: str, duration: float = None):
+        """锁定文件 duration 秒，None 表示直到 unlock_file"""
+        with self.lock:
+            self.locks[path] = None if duration is None else time.time() + duration
+
+    def unlock_file(self, path: str):
+        with self.lock:
+            self.locks.pop(path, None)
+
+    def locked_until(self, path: str):
+        """返回文件锁定截止时间，未锁定时返回0"""
+        with self.lock:
+            if path not in self.locks:
+                return 0
+            until = self.locks[path]
+            if until is not None and until <= time.time():
+                del self.locks[path]
+                return 0
+            return float('inf') if until is None else until
+
+
+class FakeJumpboxStats:
+    """服务端统计：远程执行次数（往返）、传输字节数、各类命令次数"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.round_trips = 0  # 经跳板机到目标主机的执行次数
+        self.health_checks = 0  # 跳板机本身的连接检测
+        self.bytes_in = 0  # 客户端发送的标准输入字节
+        self.bytes_out = 0  # 返回客户端的输出字节
+        self.commands = {}  # 命令类型 -> 次数
+
+    def record(self, kind: str, bytes_in: int, bytes_out: int):
+        with self.lock:
+            if kind == 'health':
+                self.health_checks += 1
+            else:
+                self.round_trips += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.commands[kind] = self.commands.get(kind, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'round_trips': self.round_trips,
+                'health_checks': self.health_checks,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'commands': dict(self.commands),
+            }
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, jumpbox):
+        self.jumpbox = jumpbox
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if username == self.jumpbox.username and password == self.jumpbox.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.jumpbox.handle_exec, args=(channel, command.decode('utf-8')),
+                                  daemon=True)
+        thread.start()
+        return True
+
+
+class FakeJumpbox:
+    """本机上的模拟跳板机
+
+    用法：
+        jumpbox = FakeJumpbox(latency=0.01)
+        target = jumpbox.add_target('10.0.0.1')
+        target.set_file(r'C:\\maa\\config\\gui.json', b'{}')
+        jumpbox.start()
+        manager.add_instance(..., jumpbox.address, jumpbox.username, jumpbox.password)
+    """
+
+    SSH_PATTERN = re.compile(r'^sshpass -p "(?P<password>[^"]*)" ssh -o StrictHostKeyChecking=no '
+                             r'(?P<username>[^@\s]+)@(?P<host>\S+) "(?P<command>.*)"$', re.S)
+    PS_STRING = r"'((?:[^']|'')*)'"
+
+    def __init__(self, username: str = 'jump', password: str = 'jump', latency: float = 0):
+        self.username = username
+        self.password = password
+        self.latency = latency  # 跳板机每次执行的额外延迟（秒）
+        self.targets = {}
+        self.stats = FakeJumpboxStats()
+        self.socket = None
+        self.transports = []
+        self.channels = set()  # 尚未处理完的通道
+        self.channels_lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    @property
+    def address(self) -> str:
+        """供 add_instance 使用的跳板机地址（host:port）"""
+        return f"127.0.0.1:{self.socket.getsockname()[1]}"
+
+    def add_target(self, host: str, username: str = 'maa', password: str = 'maa', latency: float = 0) -> FakeTarget:
+        target = FakeTarget(host, username, password, latency)
+        self.targets[host] = target
+        return target
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(16)
+        self.running = True
+        self.thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                client, _ = self.socket.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(client)
+            transport.add_server_key(get_host_key())
+            transport.start_server(server=_ServerInterface(self))
+            self.transports.append(transport)
+            threading.Thread(target=self._drain_channels, args=(transport,), daemon=True).start()
+
+    def _drain_channels(self, transport):
+        # 接受会话通道，实际处理在 exec 请求的回调中进行；
+        # transport 只保存通道的弱引用，需要在处理完之前持有通道
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is not None:
+                with self.channels_lock:
+                    self.channels.add(channel)
+
+    def handle_exec(self, channel: paramiko.Channel, command: str):
+        """执行一条来自客户端的命令"""
+        kind, output, error, exit_code, bytes_in = 'unknown', b'', b'', 1, 0
+        try:
+            # 客户端在收到 exec 应答后才会发送标准输入并关闭写端，读到EOF说明应答已送达，
+            # 之后再返回输出，避免输出先于应答到达
+            stdin = self._read_stdin(channel)
+            bytes_in = len(stdin)
+            if self.latency:
+                time.sleep(self.latency)
+            match = self.SSH_PATTERN.match(command)
+            if command == 'echo test':
+                kind, output, exit_code = 'health', b'test\n', 0
+            elif not match:
+                error = b'unsupported command\n'
+            else:
+                target = self.targets.get(match.group('host'))
+                if (target is None or not target.online or match.group('username') != target.username or
+                        match.group('password') != target.password):
+                    kind, error, exit_code = 'unreachable', b'ssh: connect to host: Connection refused\n', 255
+                else:
+                    if target.latency:
+                        time.sleep(target.latency)
+                    kind, output, error, exit_code = self._run_on_target(
+                        target, match.group('command').replace('\\"', '"'), stdin)
+        except Exception as e:
+            logger.exception("Fake jumpbox command failed")
+            error, exit_code = str(e).encode('utf-8'), 1
+        finally:
+            self.stats.record(kind, bytes_in, len(output) + len(error))
+            try:
+                if output:
+                    channel.sendall(output)
+                if error:
+                    channel.sendall_stderr(error)
+                channel.send_exit_status(exit_code)
+            except OSError:
+                # 客户端已关闭通道（如连接检测的 echo test 不读取输出）
+                pass
+            finally:
+                channel.close()
+                with self.channels_lock:
+                    self.channels.discard(channel)
+
+    @staticmethod
+    def _read_stdin(channel: paramiko.Channel, timeout: float = 5) -> bytes:
+        data = bytearray()
+        channel.settimeout(timeout)
+        try:
+            while True:
+                chunk = channel.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        except socket.timeout:
+            pass
+        return bytes(data)
+
+    def _path(self, script: str) -> str:
+        return re.search(r'\$p = ' + self.PS_STRING, script).group(1).replace("''", "'")
+
+    def _run_on_target(self, target: FakeTarget, command: str, stdin: bytes):
+        """模拟目标主机上执行的命令，返回 (类型, stdout, stderr, 退出码)"""
+        if command.startswith('echo '):
+            return 'echo', command[5:].strip('"').encode('utf-8') + b'\r\n', b'', 0
+
+        prefix = 'powershell -NoProfile -NonInteractive -EncodedCommand '
+        if not command.startswith(prefix):
+            return 'unknown', b'', b'unsupported command\r\n', 1
+        script = base64.b64decode(command[len(prefix):]).decode('utf-16-le')
+
+        if '$entries = ' in script:
+            return ('read_batch',) + self._read_batch(target, stdin)
+        if 'File]::Replace' in script:
+            return ('write',) + self._write(target, script, stdin)
+        if 'ReadAllBytes' in script:
+            return ('read',) + self._read(target, self._path(script))
+        return 'unknown', b'', b'unsupported script\r\n', 1
+
+    @staticmethod
+    def _compress(data: bytes) -> bytes:
+        return base64.b64encode(gzip.compress(data))
+
+    def _read(self, target: FakeTarget, path: str):
+        if path not in target.files:
+            return b'', b'File not found\r\n', 2
+        return self._compress(target.get_file(path)), b'', 0
+
+    def _read_batch(self, target: FakeTarget, stdin: bytes):
+        entries = [line.split('\t') for line in base64.b64decode(stdin).decode('utf-8').split('\n')]
+        paths = [entry[0] for entry in entries]
+        known = [entry[1] for entry in entries]
+        lines = []
+        for index, path in enumerate(paths):
+            if path not in target.files:
+                lines.append(f"{index}\tMISSING\t\t".encode('ascii'))
+            elif target.locked_until(path):
+                lines.append(f"{index}\tLOCKED\t\t".encode('ascii'))
+            else:
+                data = target.get_file(path)
+                file_hash = hashlib.sha256(data).hexdigest()
+                if known[index] == file_hash:
+                    lines.append(f"{index}\tUNCHANGED\t{file_hash}\t".encode('ascii'))
+                else:
+                    lines.append(f"{index}\tOK\t{file_hash}\t".encode('ascii') + self._compress(data))
+        return b''.join(line + b'\r\n' for line in lines), b'', 0
+
+    def _write(self, target: FakeTarget, script: str, stdin: bytes):
+        path = self._path(script)
+        wait = float(re.search(r'AddSeconds\(([0-9.]+)\)', script).group(1))
+        data = gzip.decompress(base64.b64decode(stdin.strip()))
+
+        deadline = time.time() + wait
+        locked_until = target.locked_until(path)
+        if locked_until > deadline:
+            time.sleep(max(0.0, deadline - time.time()))
+            return b'LOCKED\r\n', b'', 0
+        if locked_until:
+            time.sleep(max(0.0, locked_until - time.time()))
+        target.set_file(path, data)
+        return b'WRITTEN\r\n', b'', 0
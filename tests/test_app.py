@@ -0,0 +1,182 @@
+import unittest
+import sys
+import os
+import json
+import time
+import threading
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app as app_module
+from change_feed import ChangeFeed
+from config_manager import ConfigManager, STAGE_KEY
+from test_configmanager import FakeSSHManager, FakeStageManager, TARGET_HOSTS, JUMPBOX_HOST, JUMPBOX_USERNAME, JUMPBOX_PASSWORD
+
+
+class AppTestCase(unittest.TestCase):
+    """使用 FakeSSHManager 的接口测试（不启动后台任务）"""
+
+    def setUp(self):
+        self.ssh = FakeSSHManager()
+        self.feed = ChangeFeed()
+        self.manager = ConfigManager(change_feed=self.feed)
+        self.manager.ssh_manager = self.ssh
+        self.originals = (app_module.config_manager, app_module.change_feed, app_module.stage_manager)
+        app_module.config_manager = self.manager
+        app_module.change_feed = self.feed
+        app_module.stage_manager = FakeStageManager({"Official": [{"value": "1-7"}]})
+        app_module.app.testing = True
+        self.client = app_module.app.test_client()
+
+        cn = TARGET_HOSTS["cn"]
+        config = {"Current": "Default", "Configurations": {"Default": {STAGE_KEY: "CE-6"}}}
+        self.ssh.files[(cn["host"], cn["paths"][0])] = json.dumps(config)
+        self.manager.add_instance("cn_0", cn["host"], cn["username"], cn["password"], cn["paths"][0],
+                                  JUMPBOX_HOST, JUMPBOX_USERNAME, JUMPBOX_PASSWORD)
+        # 启动时离线、从未加载配置的实例
+        self.ssh.files[(cn["host"], cn["paths"][1])] = json.dumps(config)
+        self.manager.add_instance("cn_1", cn["host"], cn["username"], cn["password"], cn["paths"][1],
+                                  JUMPBOX_HOST, JUMPBOX_USERNAME, JUMPBOX_PASSWORD, refresh=False)
+
+    def tearDown(self):
+        self.manager.close()
+        app_module.config_manager, app_module.change_feed, app_module.stage_manager = self.originals
+
+    def wait_for_job(self, job_id):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            job = self.client.get(f"/api/jobs/{job_id}").get_json()
+            if job["status"] == "done":
+                return job
+            time.sleep(0.01)
+        self.fail(f"Job {job_id} did not finish")
+
+
+class TestInstanceRoutes(AppTestCase):
+    def test_not_found(self):
+        self.assertEqual(self.client.get("/api/instances/missing").status_code, 404)
+        self.assertEqual(self.client.get("/api/instances/missing/config").status_code, 404)
+        self.assertEqual(self.client.post("/api/instances/missing/config", json={"changes": {}}).status_code, 404)
+        self.assertEqual(self.client.get("/api/jobs/missing").status_code, 404)
+
+    def test_status_and_config(self):
+        statuses = self.client.get("/api/instances").get_json()
+        self.assertEqual([status["name"] for status in statuses], ["cn_0", "cn_1"])
+        status = self.client.get("/api/instances/cn_0/config").get_json()
+        self.assertTrue(status["loaded"])
+        self.assertEqual(status["config"]["Configurations"]["Default"][STAGE_KEY], "CE-6")
+
+    def test_bad_request(self):
+        response = self.client.post("/api/instances/cn_0/config", json={"stage": "1-7"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_changes_rejected_before_load(self):
+        response = self.client.post("/api/instances/cn_1/config", json={"changes": {STAGE_KEY: "1-7"}})
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(self.manager.instances["cn_1"].dirty)
+
+    def test_job_lifecycle(self):
+        response = self.client.post("/api/instances/cn_0/config", json={"changes": {STAGE_KEY: "1-7"}})
+        self.assertEqual(response.status_code, 202)
+        job = self.wait_for_job(response.get_json()["job_id"])
+
+        self.assertEqual(job["instance"], "cn_0")
+        self.assertEqual(job["result"]["status"], "updated")
+        self.assertIsNotNone(job["finished"])
+        cn = TARGET_HOSTS["cn"]
+        written = json.loads(self.ssh.files[(cn["host"], cn["paths"][0])])
+        self.assertEqual(written["Configurations"]["Default"][STAGE_KEY], "1-7")
+
+    def test_full_config_replaces_unloaded_instance(self):
+        response = self.client.post("/api/instances/cn_1/config", json={"config": {"Current": "Default"}})
+        self.assertEqual(response.status_code, 202)
+        job = self.wait_for_job(response.get_json()["job_id"])
+        self.assertNotEqual(job["result"]["status"], "not_loaded")
+
+    def test_concurrent_submissions_keep_every_job(self):
+        job_ids = []
+
+        def submit():
+            response = self.client.post("/api/instances/cn_0/config", json={"changes": {"Marked": True}})
+            job_ids.append(response.get_json()["job_id"])
+
+        threads = [threading.Thread(target=submit) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for job_id in job_ids:
+            self.assertEqual(self.wait_for_job(job_id)["status"], "done")
+
+
+class TestQueryRoutes(AppTestCase):
+    def test_query(self):
+        self.assertEqual(self.client.get("/api/instances/query?index=missing").status_code, 404)
+        self.assertEqual(self.client.get("/api/instances/query?index=stage&value=CE-6").get_json(), ["cn_0"])
+        values = self.client.get("/api/instances/query?index=stage").get_json()
+        self.assertEqual(values, [{"value": "CE-6", "instances": ["cn_0"]}])
+
+    def test_stale_stages(self):
+        stale = self.client.get("/api/instances/stale-stages").get_json()
+        self.assertEqual(stale, {"cn_0": {"stage": "CE-6", "region": "Official"}})
+
+
+class TestChangeRoutes(AppTestCase):
+    def test_cursor_bootstrap_and_resume(self):
+        version = self.client.get("/api/changes").get_json()["version"]
+        self.assertEqual(version, self.feed.version)
+
+        self.feed.publish("instance", "online", "cn_0", {"online": False})
+        body = self.client.get(f"/api/changes?since={version}&timeout=1").get_json()
+        self.assertFalse(body["reset"])
+        self.assertEqual([event["type"] for event in body["events"]], ["online"])
+        self.assertEqual(body["version"], version + 1)
+
+    def test_long_poll_wakes_on_publish(self):
+        version = self.feed.version
+        timer = threading.Timer(0.1, self.feed.publish, ("instance", "dirty", "cn_0"))
+        timer.start()
+        start = time.time()
+        body = self.client.get(f"/api/changes?since={version}&timeout=5").get_json()
+        timer.join()
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(len(body["events"]), 1)
+
+    def test_long_poll_timeout_keeps_cursor(self):
+        version = self.feed.version
+        body = self.client.get(f"/api/changes?since={version}&timeout=0.05").get_json()
+        self.assertEqual(body, {"version": version, "events": [], "reset": False})
+
+    def test_invalid_timeout(self):
+        version = self.feed.version
+        for value in ("nan", "inf", "-inf"):
+            response = self.client.get(f"/api/changes?since={version}&timeout={value}")
+            self.assertEqual(response.status_code, 400)
+
+        start = time.time()
+        body = self.client.get(f"/api/changes?since={version}&timeout=-5").get_json()
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(body["events"], [])
+
+    def test_stale_cursor_resets(self):
+        body = self.client.get(f"/api/changes?since={self.feed.version + 10}").get_json()
+        self.assertTrue(body["reset"])
+        self.assertEqual(body["version"], self.feed.version)
+
+    def test_stream_resumes_from_last_event_id(self):
+        version = self.feed.version
+        self.feed.publish("instance", "online", "cn_0", {"online": False})
+        response = self.client.get("/api/changes/stream", headers={"Last-Event-ID": str(version)})
+        try:
+            self.assertEqual(response.mimetype, "text/event-stream")
+            chunk = next(iter(response.response))
+            chunk = chunk.decode("utf-8") if isinstance(chunk, bytes) else chunk
+            self.assertTrue(chunk.startswith(f"id: {version + 1}\nevent: online\n"))
+        finally:
+            response.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
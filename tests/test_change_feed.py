@@ -0,0 +1,50 @@
+import unittest
+import sys
+import os
+import time
+import threading
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from change_feed import ChangeFeed
+
+
+class TestChangeFeed(unittest.TestCase):
+    def test_resume_from_cursor(self):
+        feed = ChangeFeed()
+        feed.publish('stages', 'stage_data', 'Official')
+        cursor = feed.publish('instance', 'online', 'cn_0', {'online': True})
+        feed.publish('instance', 'dirty', 'cn_0', {'dirty': True})
+
+        events, reset = feed.since(cursor)
+        self.assertFalse(reset)
+        self.assertEqual([event['version'] for event in events], [3])
+        self.assertEqual(events[0]['key'], 'cn_0')
+        self.assertEqual(feed.since(3), ([], False))
+
+    def test_expired_cursor_resets(self):
+        feed = ChangeFeed(max_events=2)
+        for index in range(5):
+            feed.publish('instance', 'config', f"cn_{index}")
+
+        self.assertEqual(feed.since(1), ([], True))
+        self.assertEqual(len(feed.since(3)[0]), 2)
+        # 服务重启后客户端游标可能大于当前版本
+        self.assertEqual(feed.since(10), ([], True))
+
+    def test_wait_wakes_on_publish(self):
+        feed = ChangeFeed()
+        timer = threading.Timer(0.1, feed.publish, ('instance', 'online', 'cn_0'))
+        timer.start()
+        start = time.time()
+        events, reset = feed.wait(0, timeout=5)
+        timer.join()
+
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(feed.wait(1, timeout=0.05), ([], False))
+
+
+if __name__ == "__main__":
+    unittest.main()
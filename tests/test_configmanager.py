@@ -3,11 +3,21 @@ import sys
 import os
 import json
 import time
+import gzip
+import base64
+import shutil
+import hashlib
+import socket
+import tempfile
+import threading
 
 # 添加项目根目录到Python路径
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from config_manager import ConfigManager, SSHConnectionManager
+from config_manager import ConfigManager, SSHConnectionManager, SSHTracer, SyncScheduler, CommandStream, open_stage_policy, STAGE_KEY
+from fake_jumpbox import FakeJumpbox, make_gui_config, json_bytes
+from change_feed import ChangeFeed
 
 # 跳板机连接参数
 JUMPBOX_HOST = "192.168.194.127"
@@ -109,5 +119,996 @@ class TestConfigManager(unittest.TestCase):
         self.manager.close()
 
 
+class FakeChannel:
+    """模拟paramiko通道：按顺序产出stdout/stderr数据块"""
+
+    def __init__(self, stdout=b'', stderr=b'', exit_code=0, chunk_size=7):
+        self.stdout = bytearray(stdout)
+        self.stderr = bytearray(stderr)
+        self.exit_code = exit_code
+        self.chunk_size = chunk_size
+        self.closed = False
+
+    def recv_ready(self):
+        return bool(self.stdout)
+
+    def recv(self, size):
+        size = min(size, self.chunk_size)
+        data = bytes(self.stdout[:size])
+        del self.stdout[:size]
+        return data
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv_stderr(self, size):
+        size = min(size, self.chunk_size)
+        data = bytes(self.stderr[:size])
+        del self.stderr[:size]
+        return data
+
+    def exit_status_ready(self):
+        return not self.stdout and not self.stderr
+
+    def recv_exit_status(self):
+        return self.exit_code
+
+    def close(self):
+        self.closed = True
+
+
+def fake_stream(stdout=b'', stderr=b'', exit_code=0, max_output_bytes=1024 * 1024):
+    return CommandStream(FakeChannel(stdout, stderr, exit_code), max_output_bytes, timeout=5)
+
+
+class TestCommandStream(unittest.TestCase):
+    def test_drains_stdout_and_stderr(self):
+        stream = fake_stream(b"line1\r\nline2\nlast", b"warning " * 20, exit_code=0)
+        self.assertEqual(list(stream.lines()), [b"line1", b"line2", b"last"])
+        self.assertTrue(stream.success)
+        self.assertTrue(stream.stderr.startswith("warning"))
+        self.assertTrue(stream.channel.closed)
+
+    def test_line_cap(self):
+        stream = fake_stream(b"short\r\n" + b"x" * 100 + b"\nnext\n")
+        lines = list(stream.lines(max_line_bytes=50))
+        self.assertEqual(lines, [b"short"])
+        self.assertIn("line exceeded", stream.error)
+        self.assertTrue(stream.limit_exceeded)
+        self.assertTrue(stream.channel.closed)
+
+    def test_skips_oversized_line(self):
+        heads = []
+        stream = fake_stream(b"short\r\n" + b"x" * 100 + b"\nnext\n")
+        lines = list(stream.lines(max_line_bytes=50, on_oversized=heads.append))
+        self.assertEqual(lines, [b"short", b"next"])
+        self.assertEqual(len(heads), 1)
+        self.assertTrue(heads[0].startswith(b"xxx"))
+        self.assertTrue(stream.success)
+
+    def test_output_cap(self):
+        stream = fake_stream(b"x" * 100, max_output_bytes=50)
+        received = b''.join(stream)
+        self.assertLessEqual(len(received), 50)
+        self.assertFalse(stream.success)
+        self.assertIn("exceeded", stream.error)
+
+    def test_execute_collects_output(self):
+        ssh_manager = SSHConnectionManager()
+        ssh_manager.stream_command_via_jumpbox = lambda *args, **kwargs: fake_stream(b"ok", exit_code=0)
+        self.assertEqual(ssh_manager.execute_command_via_jumpbox("j", "u", "p", "t", "u", "p", "cmd"), (True, "ok"))
+        ssh_manager.stream_command_via_jumpbox = lambda *args, **kwargs: fake_stream(b"", b"boom", exit_code=1)
+        self.assertEqual(ssh_manager.execute_command_via_jumpbox("j", "u", "p", "t", "u", "p", "cmd"), (False, "boom"))
+
+
+class TestCompressedTransfer(unittest.TestCase):
+    """压缩传输解码测试（不需要真实主机）"""
+
+    def setUp(self):
+        self.ssh_manager = SSHConnectionManager()
+        self.raw = '\ufeff{"Current": "Default", "Tip": "\u6d4b\u8bd5\\u0001"}'.encode('utf-8')
+
+    def fake_output(self, data):
+        encoded = base64.b64encode(gzip.compress(data)).decode('ascii')
+        # 模拟PowerShell输出中的换行
+        return encoded[:10] + '\r\n' + encoded[10:] + '\r\n'
+
+    def test_decode_payload_is_exact(self):
+        decoded = SSHConnectionManager.decode_compressed_payload(self.fake_output(self.raw))
+        self.assertEqual(decoded, self.raw)
+
+    def test_read_file_parses_without_cleaning(self):
+        output = self.fake_output(self.raw).encode('ascii')
+        self.ssh_manager.stream_command_via_jumpbox = lambda *args, **kwargs: fake_stream(output)
+        success, content = self.ssh_manager.read_file_via_jumpbox(
+            "jumpbox", "user", "pass", "target", "user", "pass", r"C:\maa\config\gui.json"
+        )
+        self.assertTrue(success)
+        self.assertEqual(json.loads(content)["Tip"], "\u6d4b\u8bd5\u0001")
+
+    def test_read_file_rejects_corrupted_payload(self):
+        self.ssh_manager.stream_command_via_jumpbox = lambda *args, **kwargs: fake_stream(b"not base64!")
+        success, content = self.ssh_manager.read_file_via_jumpbox(
+            "jumpbox", "user", "pass", "target", "user", "pass", r"C:\maa\config\gui.json"
+        )
+        self.assertFalse(success)
+
+    def test_powershell_command_is_encoded(self):
+        command = SSHConnectionManager.build_powershell_command("Write-Output \"$x 'y'\"")
+        self.assertNotIn('"', command)
+        self.assertNotIn('$', command)
+
+
+class FakeSSHManager:
+    """内存中的SSH管理器替身，按 (主机, 路径) 保存文件"""
+
+    def __init__(self):
+        self.files = {}
+        self.offline_hosts = set()
+        self.locked = set()
+        self.released_on_wait = set()
+        self.calls = 0
+        self.reads = 0
+
+    def execute_command_via_jumpbox(self, jumpbox_host, jumpbox_username, jumpbox_password,
+                                    target_host, target_username, target_password, command, operation="exec"):
+        self.calls += 1
+        if target_host in self.offline_hosts:
+            return False, "Connection refused"
+        return True, "Connection test"
+
+    def read_files_via_jumpbox(self, jumpbox_host, jumpbox_username, jumpbox_password,
+                               target_host, target_username, target_password, file_paths, known_hashes=None):
+        self.calls += 1
+        if target_host in self.offline_hosts:
+            return False, {}
+        results = {}
+        for path in file_paths:
+            if (target_host, path) in self.locked:
+                results[path] = {'status': 'locked', 'hash': None, 'data': None, 'error': None}
+                continue
+            if (target_host, path) not in self.files:
+                results[path] = {'status': 'missing', 'hash': None, 'data': None, 'error': None}
+                continue
+            data = self.files[(target_host, path)].encode('utf-8')
+            file_hash = hashlib.sha256(data).hexdigest()
+            if (known_hashes or {}).get(path) == file_hash:
+                results[path] = {'status': 'unchanged', 'hash': file_hash, 'data': None, 'error': None}
+                continue
+            self.reads += 1
+            results[path] = {'status': 'ok', 'hash': file_hash, 'data': data, 'error': None}
+        return True, results
+
+    def write_file_when_unlocked_via_jumpbox(self, jumpbox_host, jumpbox_username, jumpbox_password,
+                                             target_host, target_username, target_password, file_path, data,
+                                             wait_timeout=0):
+        self.calls += 1
+        if target_host in self.offline_hosts:
+            return False, 'error'
+        if (target_host, file_path) in self.locked:
+            # 在等待期间被释放
+            if wait_timeout > 0 and (target_host, file_path) in self.released_on_wait:
+                self.locked.discard((target_host, file_path))
+            else:
+                return False, 'locked'
+        self.files[(target_host, file_path)] = data.decode('utf-8')
+        return True, 'written'
+
+    def close_all(self):
+        pass
+
+
+class OfflineTestCase(unittest.TestCase):
+    """使用 FakeSSHManager 的离线测试基类"""
+
+    cache_dir = None
+
+    def setUp(self):
+        self.ssh = FakeSSHManager()
+        self.manager = self.create_manager()
+        for target_name, target_info in TARGET_HOSTS.items():
+            for path in target_info["paths"]:
+                self.ssh.files[(target_info["host"], path)] = json.dumps({"Current": "Default", "Region": target_name})
+
+    def create_manager(self):
+        manager = ConfigManager(cache_dir=self.cache_dir)
+        manager.ssh_manager = self.ssh
+        return manager
+
+    def add_instance(self, name, target_name="cn", index=0, manager=None):
+        target_info = TARGET_HOSTS[target_name]
+        return (manager or self.manager).add_instance(
+            name, target_info["host"], target_info["username"], target_info["password"],
+            target_info["paths"][index], JUMPBOX_HOST, JUMPBOX_USERNAME, JUMPBOX_PASSWORD
+        )
+
+    def tearDown(self):
+        self.manager.close()
+
+
+class TestSyncScheduler(OfflineTestCase):
+    def test_offline_instance_backs_off(self):
+        self.ssh.offline_hosts.add(TARGET_HOSTS["cn"]["host"])
+        self.add_instance("cn_maa159")
+        scheduler = SyncScheduler(self.manager, retry_interval=5, max_backoff=30)
+
+        delays = [scheduler.run_once("cn_maa159") for _ in range(5)]
+        self.assertEqual(delays, [5, 10, 20, 30, 30])
+
+    def test_backoff_does_not_overflow(self):
+        self.ssh.offline_hosts.add(TARGET_HOSTS["cn"]["host"])
+        self.add_instance("cn_maa159")
+        scheduler = SyncScheduler(self.manager, retry_interval=0.5, max_backoff=600)
+        scheduler.failures["cn_maa159"] = 5000
+        self.assertEqual(scheduler.next_delay("cn_maa159"), 600)
+
+    def test_worker_survives_errors(self):
+        self.add_instance("cn_maa159")
+        scheduler = SyncScheduler(self.manager, workers=1, jitter=0)
+
+        def broken(names):
+            raise RuntimeError("boom")
+
+        scheduler.run_batch = broken
+        scheduler.schedule("cn_maa159", 0)
+        scheduler.start()
+        try:
+            deadline = time.time() + 2
+            while "cn_maa159" not in scheduler.due and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertNotIn("cn_maa159", scheduler.in_flight)
+            self.assertGreater(scheduler.due["cn_maa159"], time.time())
+            self.assertTrue(all(thread.is_alive() for thread in scheduler.threads))
+        finally:
+            scheduler.stop()
+
+    def test_due_instances_batched_per_host(self):
+        self.add_instance("cn_0", "cn", 0)
+        self.add_instance("cn_1", "cn", 1)
+        self.add_instance("jp_0", "jp", 0)
+        for instance in self.manager.instances.values():
+            instance.last_update = 0
+        self.ssh.calls = 0
+        scheduler = SyncScheduler(self.manager, jitter=0, batch_window=30)
+        scheduler.schedule("cn_0", 0)
+        scheduler.schedule("cn_1", 10)
+        scheduler.schedule("jp_0", 0)
+        scheduler.running = True
+
+        first = scheduler._pop_due()
+        second = scheduler._pop_due()
+        self.assertEqual(sorted(first + second), ["cn_0", "cn_1", "jp_0"])
+        batch = first if "cn_0" in first else second
+        self.assertEqual(sorted(batch), ["cn_0", "cn_1"])
+
+        delays = scheduler.run_batch(batch)
+        self.assertEqual(self.ssh.calls, 1)
+        self.assertEqual(delays, {"cn_0": self.manager.sync_interval, "cn_1": self.manager.sync_interval})
+        scheduler._finish(batch, delays)
+        self.assertEqual(scheduler.due["cn_0"], scheduler.due["cn_1"])
+        self.assertEqual(scheduler.in_flight, {"jp_0"})
+
+    def test_dirty_instance_pushed_when_back_online(self):
+        host = TARGET_HOSTS["cn"]["host"]
+        path = TARGET_HOSTS["cn"]["paths"][0]
+        instance = self.add_instance("cn_maa159")
+        self.ssh.offline_hosts.add(host)
+        instance.online = False
+        self.manager.update_config("cn_maa159", {"Current": "Changed"})
+        self.assertTrue(instance.dirty)
+
+        scheduler = SyncScheduler(self.manager, retry_interval=5)
+        self.assertEqual(scheduler.run_once("cn_maa159"), 5)
+
+        self.ssh.offline_hosts.discard(host)
+        self.assertEqual(scheduler.run_once("cn_maa159"), self.manager.sync_interval)
+        self.assertFalse(instance.dirty)
+        self.assertEqual(json.loads(self.ssh.files[(host, path)])["Current"], "Changed")
+
+    def test_locked_dirty_instance_retries_promptly(self):
+        host = TARGET_HOSTS["cn"]["host"]
+        path = TARGET_HOSTS["cn"]["paths"][0]
+        self.add_instance("cn_maa159")
+        self.ssh.locked.add((host, path))
+        self.manager.update_config("cn_maa159", {"Current": "Changed"})
+
+        scheduler = SyncScheduler(self.manager, retry_interval=2)
+        self.assertEqual(scheduler.run_once("cn_maa159"), 2)
+
+    def test_start_and_stop(self):
+        self.add_instance("cn_maa159")
+        self.manager.sync_interval = 0.01
+        scheduler = self.manager.start_scheduler(workers=2)
+        time.sleep(0.2)
+        self.manager.stop_scheduler(timeout=1)
+        self.assertFalse(scheduler.running)
+        self.assertGreater(self.ssh.calls, 3)
+
+
+class TestLockAwareWrite(OfflineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.host = TARGET_HOSTS["cn"]["host"]
+        self.path = TARGET_HOSTS["cn"]["paths"][0]
+        self.instance = self.add_instance("cn_maa159")
+        self.ssh.calls = 0
+
+    def test_write_lands_when_lock_released(self):
+        self.ssh.locked.add((self.host, self.path))
+        self.ssh.released_on_wait.add((self.host, self.path))
+
+        self.assertTrue(self.manager.update_config("cn_maa159", {"Current": "Changed"}))
+        self.assertEqual(self.ssh.calls, 1)
+        self.assertFalse(self.instance.dirty)
+        data = self.ssh.files[(self.host, self.path)].encode('utf-8')
+        self.assertEqual(self.instance.remote_hash, hashlib.sha256(data).hexdigest())
+
+    def test_timeout_leaves_instance_dirty(self):
+        self.ssh.locked.add((self.host, self.path))
+        self.assertFalse(self.manager.update_config("cn_maa159", {"Current": "Changed"}))
+        self.assertTrue(self.instance.dirty)
+        self.assertEqual(self.instance.config, {"Current": "Changed"})
+
+    def test_no_wait_fails_fast(self):
+        self.ssh.locked.add((self.host, self.path))
+        self.ssh.released_on_wait.add((self.host, self.path))
+        self.assertFalse(self.manager.update_config("cn_maa159", {"Current": "Changed"}, wait_for_unlock=0))
+        self.assertTrue(self.instance.dirty)
+
+
+class TestUpdateQueue(OfflineTestCase):
+    def test_status_served_from_memory(self):
+        self.add_instance("cn_maa159")
+        self.ssh.calls = 0
+        status = self.manager.get_instance_status("cn_maa159", include_config=True)
+        self.assertEqual(self.ssh.calls, 0)
+        self.assertTrue(status["online"])
+        self.assertFalse(status["stale"])
+        self.assertEqual(status["config"]["Region"], "cn")
+        self.assertIsNone(self.manager.get_instance_status("missing"))
+
+    def test_queued_update_runs_in_background(self):
+        self.add_instance("cn_maa159")
+
+        def mutate(instance, config):
+            config["Region"] = "queued"
+            return config
+
+        job_id = self.manager.queue_update("cn_maa159", mutate)
+        self.manager.update_queue.shutdown()
+        job = self.manager.get_job(job_id)
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["result"]["status"], "updated")
+        self.assertEqual(self.manager.instances["cn_maa159"].config["Region"], "queued")
+
+    def test_load_instances(self):
+        definitions = [{
+            "name": "cn_maa159", "target_host": TARGET_HOSTS["cn"]["host"],
+            "target_username": TARGET_HOSTS["cn"]["username"], "target_password": TARGET_HOSTS["cn"]["password"],
+            "path": TARGET_HOSTS["cn"]["paths"][0], "jumpbox_host": JUMPBOX_HOST,
+            "jumpbox_username": JUMPBOX_USERNAME, "jumpbox_password": JUMPBOX_PASSWORD
+        }]
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump(definitions, f)
+        try:
+            instances = self.manager.load_instances(f.name)
+        finally:
+            os.remove(f.name)
+        self.assertEqual(instances[0].config["Region"], "cn")
+
+
+class FakeStageManager:
+    def __init__(self, open_stages):
+        self.open_stages = open_stages
+        self.queries = []
+
+    def get_open_stages(self, day_of_week=None, client_type='Official'):
+        self.queries.append(client_type)
+        return self.open_stages.get(client_type, [])
+
+
+class TestFanOut(OfflineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_instance("cn_maa159", "cn", 0)
+        self.add_instance("cn_maa177", "cn", 1)
+        self.add_instance("jp_maa512", "jp", 0)
+        self.add_instance("jp_maajp", "jp", 1)
+
+    def test_apply_reports_per_instance(self):
+        self.manager.instances["jp_maa512"].online = False
+
+        def mutate(instance, config):
+            if instance.name == "cn_maa177":
+                return None
+            if instance.name == "jp_maajp":
+                raise ValueError("bad config")
+            config["Marked"] = True
+            return config
+
+        results = self.manager.apply_to_instances(mutate, ["cn_maa159", "cn_maa177", "jp_maa512", "jp_maajp", "missing"])
+        self.assertEqual(results["cn_maa159"]["status"], "updated")
+        self.assertEqual(results["cn_maa177"]["status"], "unchanged")
+        self.assertEqual(results["jp_maa512"]["status"], "pending")
+        self.assertEqual(results["jp_maajp"]["status"], "error")
+        self.assertEqual(results["missing"]["status"], "not_found")
+        self.assertTrue(self.manager.instances["jp_maa512"].dirty)
+        stored = json.loads(self.ssh.files[(TARGET_HOSTS["cn"]["host"], TARGET_HOSTS["cn"]["paths"][0])])
+        self.assertTrue(stored["Marked"])
+
+    def test_skips_instance_never_loaded(self):
+        host = TARGET_HOSTS["cn"]["host"]
+        path = TARGET_HOSTS["cn"]["paths"][0]
+        self.ssh.offline_hosts.add(host)
+        self.manager.remove_instance("cn_maa159")
+        self.add_instance("cn_maa159", "cn", 0)
+        self.ssh.offline_hosts.discard(host)
+
+        def set_stage(instance, config):
+            config[STAGE_KEY] = "CE-6"
+            return config
+
+        results = self.manager.apply_to_instances(set_stage, ["cn_maa159"])
+        self.assertEqual(results["cn_maa159"]["status"], "not_loaded")
+        instance = self.manager.instances["cn_maa159"]
+        self.assertFalse(instance.dirty)
+        self.assertEqual(instance.config, {})
+
+        self.manager.sync_instance("cn_maa159")
+        self.assertEqual(json.loads(self.ssh.files[(host, path)])["Region"], "cn")
+        self.assertTrue(instance.loaded)
+
+    def test_group_by_host(self):
+        groups = self.manager.group_by_host()
+        self.assertEqual(len(groups), 2)
+        self.assertTrue(all(len(instances) == 2 for instances in groups.values()))
+
+    def test_open_stage_policy_uses_client_region(self):
+        self.manager.instances["cn_maa159"].config = {
+            "Current": "Default",
+            "Configurations": {"Default": {STAGE_KEY: "EA-8", "Start.ClientType": "Bilibili"}}
+        }
+        self.manager.instances["cn_maa177"].config = {
+            "Current": "Default",
+            "Configurations": {"Default": {STAGE_KEY: "1-7", "Start.ClientType": "Official"}}
+        }
+        self.manager.instances["jp_maa512"].config = {
+            "Current": "Default",
+            "Configurations": {"Default": {STAGE_KEY: "EA-8", "Start.ClientType": "YoStarJP"}}
+        }
+        # 空关卡表示"当前/上次"，不应被改写
+        self.manager.instances["jp_maajp"].config = {
+            "Current": "Default",
+            "Configurations": {"Default": {STAGE_KEY: "", "Start.ClientType": "YoStarJP"}}
+        }
+        stage_manager = FakeStageManager({
+            "Official": [{"value": "1-7"}, {"value": "SSReopen-HS", "activity": {}}],
+            "YoStarJP": [{"value": "1-7"}, {"value": "CE-6"}],
+        })
+
+        results = self.manager.apply_to_instances(open_stage_policy(stage_manager),
+                                                  ["cn_maa159", "cn_maa177", "jp_maa512", "jp_maajp"])
+        self.assertEqual(results["cn_maa159"]["status"], "updated")
+        self.assertEqual(results["cn_maa177"]["status"], "unchanged")
+        self.assertEqual(results["jp_maa512"]["status"], "updated")
+        self.assertEqual(results["jp_maajp"]["status"], "unchanged")
+
+        def stage_of(name):
+            return self.manager.instances[name].config["Configurations"]["Default"][STAGE_KEY]
+
+        self.assertEqual(stage_of("cn_maa159"), "SSReopen-HS")
+        self.assertEqual(stage_of("jp_maa512"), "1-7")
+        self.assertEqual(stage_of("jp_maajp"), "")
+        self.assertEqual(sorted(set(stage_manager.queries)), ["Official", "YoStarJP"])
+        self.assertEqual(len(stage_manager.queries), 2)
+
+
+class TestConfigIndex(OfflineTestCase):
+    def setUp(self):
+        super().setUp()
+        profiles = {
+            ("cn", 0): {STAGE_KEY: "CE-6", "Start.ClientType": "Official", "Mall.Enabled": "False"},
+            ("cn", 1): {STAGE_KEY: "SS-8", "Start.ClientType": "Bilibili", "Mall.Enabled": "True"},
+            ("jp", 0): {STAGE_KEY: "SS-8", "Start.ClientType": "YoStarJP"},
+            ("jp", 1): {STAGE_KEY: "", "Start.ClientType": "YoStarJP"},
+        }
+        for (target_name, index), profile in profiles.items():
+            config = {"Current": "Default", "Configurations": {"Default": profile}}
+            self.ssh.files[(TARGET_HOSTS[target_name]["host"], TARGET_HOSTS[target_name]["paths"][index])] = json.dumps(config)
+            self.add_instance(f"{target_name}_{index}", target_name, index)
+
+    def test_incremental_updates(self):
+        self.assertEqual(self.manager.query("stage", "SS-8"), ["cn_1", "jp_0"])
+        self.assertEqual(self.manager.query("region", "YoStarJP"), ["jp_0", "jp_1"])
+
+        def set_stage(instance, config):
+            config["Configurations"]["Default"][STAGE_KEY] = "1-7"
+            return config
+
+        self.manager.apply_to_instances(set_stage, ["jp_0"])
+        self.assertEqual(self.manager.query("stage", "SS-8"), ["cn_1"])
+        self.assertEqual(self.manager.query("stage", "1-7"), ["jp_0"])
+
+        self.manager.remove_instance("cn_1")
+        self.assertNotIn("SS-8", self.manager.index_values("stage"))
+
+    def test_custom_index(self):
+        self.manager.add_index("Mall.Enabled")
+        self.assertEqual(self.manager.index_values("Mall.Enabled"), {"False": ["cn_0"], "True": ["cn_1"], None: ["jp_0", "jp_1"]})
+
+    def test_find_stale_stages(self):
+        stage_manager = FakeStageManager({
+            "Official": [{"value": "CE-6"}],
+            "YoStarJP": [{"value": "CE-6"}, {"value": "1-7"}],
+        })
+        stale = self.manager.find_stale_stages(stage_manager)
+        self.assertEqual(stale, {
+            "cn_1": {"stage": "SS-8", "region": "Official"},
+            "jp_0": {"stage": "SS-8", "region": "YoStarJP"},
+        })
+        self.assertEqual(sorted(stage_manager.queries), ["Official", "YoStarJP"])
+
+
+class TestChangeFeedEvents(OfflineTestCase):
+    def create_manager(self):
+        self.feed = ChangeFeed()
+        manager = ConfigManager(change_feed=self.feed)
+        manager.ssh_manager = self.ssh
+        return manager
+
+    def events(self):
+        return [(event['key'], event['type']) for event in self.feed.since(0)[0]]
+
+    def test_instance_events(self):
+        self.add_instance("cn_maa159")
+        self.assertEqual(self.events(), [("cn_maa159", "added"), ("cn_maa159", "config"), ("cn_maa159", "online")])
+
+        cursor = self.feed.version
+        self.manager.refresh_instance("cn_maa159")
+        self.assertEqual(self.feed.since(cursor), ([], False))
+        self.ssh.files[(TARGET_HOSTS["cn"]["host"], TARGET_HOSTS["cn"]["paths"][0])] = json.dumps({"Region": "new"})
+        self.manager.refresh_instance("cn_maa159")
+        self.assertEqual([event["type"] for event in self.feed.since(cursor)[0]], ["config"])
+
+        cursor = self.feed.version
+        self.ssh.offline_hosts.add(TARGET_HOSTS["cn"]["host"])
+        self.manager.refresh_instance("cn_maa159")
+        self.manager.update_config("cn_maa159", {"Region": "local"})
+        events, _ = self.feed.since(cursor)
+        self.assertEqual([event["type"] for event in events], ["online", "config", "dirty"])
+        self.assertFalse(events[0]["data"]["online"])
+        self.assertTrue(events[2]["data"]["dirty"])
+
+        self.manager.remove_instance("cn_maa159")
+        self.assertEqual(self.events()[-1], ("cn_maa159", "removed"))
+
+    def test_locked_retries_are_quiet(self):
+        host = TARGET_HOSTS["cn"]["host"]
+        path = TARGET_HOSTS["cn"]["paths"][0]
+        self.add_instance("cn_maa159")
+        self.ssh.locked.add((host, path))
+        self.manager.update_config("cn_maa159", {"Region": "local"}, wait_for_unlock=0)
+
+        cursor = self.feed.version
+        for _ in range(5):
+            self.manager.sync_instance("cn_maa159")
+        self.assertEqual(self.feed.since(cursor), ([], False))
+
+        self.ssh.locked.discard((host, path))
+        self.manager.sync_instance("cn_maa159")
+        events, _ = self.feed.since(cursor)
+        self.assertEqual([event["type"] for event in events], ["dirty"])
+        self.assertFalse(events[0]["data"]["dirty"])
+
+    def test_unchanged_revalidation_is_quiet(self):
+        self.add_instance("cn_maa159")
+        cursor = self.feed.version
+        self.manager.revalidate_instance("cn_maa159")
+        self.assertEqual(self.feed.since(cursor), ([], False))
+
+
+class TestPersistentCache(OfflineTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    def restart(self):
+        self.manager.close()
+        self.ssh.reads = 0
+        self.manager = self.create_manager()
+
+    def test_warm_restart_revalidates_by_hash(self):
+        self.add_instance("cn_maa159")
+        self.restart()
+
+        instance = self.add_instance("cn_maa159")
+        self.assertEqual(instance.config["Region"], "cn")
+        self.manager.close()  # 等待后台校验完成
+        self.assertTrue(instance.online)
+        self.assertEqual(self.ssh.reads, 0)
+
+    def test_warm_restart_rereads_changed_file(self):
+        self.add_instance("cn_maa159")
+        self.ssh.files[(TARGET_HOSTS["cn"]["host"], TARGET_HOSTS["cn"]["paths"][0])] = json.dumps({"Region": "changed"})
+        self.restart()
+
+        instance = self.add_instance("cn_maa159")
+        self.manager.close()
+        self.assertEqual(self.ssh.reads, 1)
+        self.assertEqual(instance.config["Region"], "changed")
+
+    def test_warm_restart_batches_per_host(self):
+        definitions = [{
+            "name": f"{target_name}_{index}", "target_host": target_info["host"],
+            "target_username": target_info["username"], "target_password": target_info["password"],
+            "path": path, "jumpbox_host": JUMPBOX_HOST,
+            "jumpbox_username": JUMPBOX_USERNAME, "jumpbox_password": JUMPBOX_PASSWORD
+        } for target_name, target_info in TARGET_HOSTS.items() for index, path in enumerate(target_info["paths"])]
+        instances_file = os.path.join(self.cache_dir, "instances.json")
+        with open(instances_file, "w") as f:
+            json.dump(definitions, f)
+
+        self.manager.load_instances(instances_file)
+        self.assertEqual(self.ssh.calls, len(TARGET_HOSTS))
+        self.restart()
+        self.ssh.calls = 0
+
+        instances = self.manager.load_instances(instances_file)
+        self.manager.close()
+        self.assertEqual(self.ssh.calls, len(TARGET_HOSTS))
+        self.assertEqual(self.ssh.reads, 0)
+        self.assertTrue(all(instance.online for instance in instances))
+
+    def test_dirty_changes_survive_restart(self):
+        host = TARGET_HOSTS["cn"]["host"]
+        path = TARGET_HOSTS["cn"]["paths"][0]
+        instance = self.add_instance("cn_maa159")
+        instance.online = False
+        self.manager.update_config("cn_maa159", {"Region": "local"})
+        self.restart()
+
+        instance = self.add_instance("cn_maa159")
+        self.assertTrue(instance.dirty or json.loads(self.ssh.files[(host, path)])["Region"] == "local")
+        self.manager.close()
+        self.assertFalse(instance.dirty)
+        self.assertEqual(json.loads(self.ssh.files[(host, path)])["Region"], "local")
+
+
+class TestBatchRead(OfflineTestCase):
+    def setUp(self):
+        super().setUp()
+        for target_name in TARGET_HOSTS:
+            self.add_instance(f"{target_name}_0", target_name, 0, refresh=False)
+            self.add_instance(f"{target_name}_1", target_name, 1, refresh=False)
+
+    def add_instance(self, name, target_name="cn", index=0, manager=None, refresh=True):
+        target_info = TARGET_HOSTS[target_name]
+        return self.manager.add_instance(
+            name, target_info["host"], target_info["username"], target_info["password"],
+            target_info["paths"][index], JUMPBOX_HOST, JUMPBOX_USERNAME, JUMPBOX_PASSWORD, refresh=refresh
+        )
+
+    def test_one_execution_per_host(self):
+        self.ssh.locked.add((TARGET_HOSTS["jp"]["host"], TARGET_HOSTS["jp"]["paths"][1]))
+        results = self.manager.refresh_all()
+        self.assertEqual(self.ssh.calls, 2)
+        self.assertEqual(results, {"cn_0": True, "cn_1": True, "jp_0": True, "jp_1": False})
+        self.assertEqual(self.manager.instances["jp_0"].config["Region"], "jp")
+        self.assertTrue(self.manager.instances["jp_1"].online)
+
+    def test_revalidate_keeps_local_changes(self):
+        self.manager.refresh_all()
+        host = TARGET_HOSTS["cn"]["host"]
+        instance = self.manager.instances["cn_0"]
+        # 离线期间排队的修改（判断过期之后、取得锁之前产生）
+        instance.online = False
+        self.manager.update_config("cn_0", {"Region": "local"})
+        self.ssh.files[(host, TARGET_HOSTS["cn"]["paths"][0])] = json.dumps({"Region": "remote"})
+        self.ssh.files[(host, TARGET_HOSTS["cn"]["paths"][1])] = json.dumps({"Region": "remote"})
+        self.ssh.calls = 0
+
+        results = self.manager.refresh_all(["cn_0", "cn_1"], revalidate=True)
+        self.assertEqual(results, {"cn_0": False, "cn_1": True})
+        self.assertEqual(self.ssh.calls, 1)
+        self.assertTrue(instance.dirty)
+        self.assertEqual(instance.config, {"Region": "local"})
+        self.assertEqual(self.manager.instances["cn_1"].config, {"Region": "remote"})
+
+        self.assertEqual(self.manager.refresh_all(["cn_0"], revalidate=True), {"cn_0": False})
+        self.assertEqual(self.ssh.calls, 1)
+
+    def test_unparsable_file_is_reread(self):
+        key = (TARGET_HOSTS["cn"]["host"], TARGET_HOSTS["cn"]["paths"][0])
+        self.ssh.files[key] = '{"Region": "half'
+        self.manager.refresh_all()
+        instance = self.manager.instances["cn_0"]
+        self.assertIsNone(instance.remote_hash)
+        self.assertFalse(instance.loaded)
+        self.assertEqual(instance.config, {})
+
+        self.ssh.files[key] = json.dumps({"Region": "cn"})
+        self.ssh.reads = 0
+        self.manager.sync_all()
+        self.assertEqual(self.ssh.reads, 1)
+        self.assertEqual(instance.config, {"Region": "cn"})
+        self.assertTrue(instance.loaded)
+
+    def test_revalidate_skips_unchanged_files(self):
+        self.manager.refresh_all()
+        self.ssh.reads = 0
+        self.ssh.files[(TARGET_HOSTS["cn"]["host"], TARGET_HOSTS["cn"]["paths"][0])] = json.dumps({"Region": "new"})
+        for instance in self.manager.instances.values():
+            instance.last_update = 0
+
+        self.manager.sync_all()
+        self.assertEqual(self.ssh.reads, 1)
+        self.assertEqual(self.manager.instances["cn_0"].config["Region"], "new")
+        self.assertTrue(all(instance.last_update > 0 for instance in self.manager.instances.values()))
+
+
+class TestSSHTracer(unittest.TestCase):
+    def test_histogram_and_slow_log(self):
+        tracer = SSHTracer(slow_threshold=0.2)
+        with tracer.context(instance="cn_0"):
+            span = tracer.start_span("read_batch", "jumpbox", "target", bytes_out=100)
+        span["start"] -= 0.3
+        with self.assertLogs("config_manager", level="WARNING") as logs:
+            tracer.finish_span(span, True, bytes_in=500)
+        tracer.finish_span(tracer.start_span("write", "jumpbox", "target"), False, error="Exit code 1")
+
+        stats = tracer.snapshot()
+        host = stats["hosts"]["target"]
+        self.assertEqual(stats["round_trips"], 2)
+        self.assertEqual(host["errors"], 1)
+        self.assertEqual(host["operations"], {"read_batch": 1, "write": 1})
+        self.assertEqual(host["histogram"]["0.05"], 1)
+        self.assertEqual(host["histogram"]["0.5"], 1)
+        self.assertEqual(tracer.recent_spans()[0]["instance"], "cn_0")
+        self.assertIn("Slow read_batch on target (instance cn_0)", logs.output[0])
+
+
+class TestBatchReadParsing(unittest.TestCase):
+    def test_multiplexed_output(self):
+        ssh_manager = SSHConnectionManager()
+        payload = base64.b64encode(gzip.compress(b'{"a": 1}')).decode('ascii')
+        message = base64.b64encode("Access denied".encode('utf-8')).decode('ascii')
+        output = f"0\tOK\tabc\t{payload}\r\n1\tLOCKED\t\t\r\n2\tUNCHANGED\tdef\t\r\n3\tERROR\t\t{message}\r\n"
+        ssh_manager.stream_command_via_jumpbox = lambda *args, **kwargs: fake_stream(output.encode('utf-8'))
+        paths = ["a.json", "b.json", "c.json", "d.json", "e.json"]
+
+        success, results = ssh_manager.read_files_via_jumpbox(
+            "jumpbox", "user", "pass", "target", "user", "pass", paths, {"c.json": "def"}
+        )
+        self.assertTrue(success)
+        self.assertEqual(results["a.json"]["data"], b'{"a": 1}')
+        self.assertEqual(results["b.json"]["status"], "locked")
+        self.assertEqual(results["c.json"]["status"], "unchanged")
+        self.assertEqual(results["d.json"]["error"], "Access denied")
+        self.assertEqual(results["e.json"]["status"], "error")
+
+
+class TestFakeJumpbox(unittest.TestCase):
+    """通过本地模拟跳板机走完整的SSH链路"""
+
+    hosts = ["10.0.0.1", "10.0.0.2"]
+    path = r"C:\Users\maa\Desktop\maa\config\gui.json"
+
+    def setUp(self):
+        self.jumpbox = FakeJumpbox().start()
+        self.manager = ConfigManager()
+        for host in self.hosts:
+            target = self.jumpbox.add_target(host)
+            for index in range(2):
+                target.set_file(f"{self.path}.{index}", json_bytes(make_gui_config(2000)))
+                self.manager.add_instance(
+                    f"{host}-{index}", host, target.username, target.password, f"{self.path}.{index}",
+                    self.jumpbox.address, self.jumpbox.username, self.jumpbox.password, refresh=False
+                )
+
+    def tearDown(self):
+        self.manager.close()
+        self.jumpbox.stop()
+
+    def test_refresh_all_batches_per_host(self):
+        results = self.manager.refresh_all()
+        self.assertTrue(all(results.values()))
+        self.assertEqual(self.jumpbox.stats.snapshot()["round_trips"], len(self.hosts))
+        self.assertEqual(self.manager.instances["10.0.0.1-0"].config["Current"], "Default")
+
+    def test_write_waits_for_lock_release(self):
+        self.manager.lock_wait_timeout = 5
+        self.manager.refresh_instance("10.0.0.1-0")
+        target = self.jumpbox.targets["10.0.0.1"]
+        target.lock_file(f"{self.path}.0", duration=0.3)
+
+        config = self.manager.instances["10.0.0.1-0"].config
+        config["Configurations"]["Default"][STAGE_KEY] = "CE-6"
+        self.assertTrue(self.manager.update_config("10.0.0.1-0", config))
+        written = json.loads(target.get_file(f"{self.path}.0").decode("utf-8"))
+        self.assertEqual(written["Configurations"]["Default"][STAGE_KEY], "CE-6")
+
+    def test_offline_target(self):
+        self.jumpbox.targets["10.0.0.2"].online = False
+        results = self.manager.refresh_all()
+        self.assertTrue(results["10.0.0.1-0"])
+        self.assertFalse(results["10.0.0.2-0"])
+        self.assertFalse(self.manager.instances["10.0.0.2-1"].online)
+
+    def test_ssh_stats(self):
+        self.manager.refresh_all()
+        self.manager.refresh_instance("10.0.0.1-0")
+        stats = self.manager.get_ssh_stats()
+
+        self.assertEqual(stats["round_trips"], 3)
+        self.assertEqual(stats["hosts"]["10.0.0.1"]["operations"], {"read_batch": 2})
+        self.assertEqual(sum(stats["hosts"]["10.0.0.1"]["histogram"].values()), 2)
+        self.assertGreater(stats["hosts"]["10.0.0.2"]["bytes_in"], 0)
+        self.assertEqual(stats["jumpboxes"][self.jumpbox.address]["connects"], 1)
+        self.assertEqual(stats["jumpboxes"][self.jumpbox.address]["channels"], 3)
+        spans = self.manager.tracer.recent_spans()
+        self.assertEqual(spans[-1]["instance"], "10.0.0.1-0")
+        self.assertIsNotNone(spans[-1]["first_byte_seconds"])
+
+    def test_slow_jumpbox_does_not_block_others(self):
+        # 只监听不应答的端口：连接会一直等待SSH握手
+        silent = socket.socket()
+        silent.bind(("127.0.0.1", 0))
+        silent.listen(8)
+        silent_address = "127.0.0.1:%d" % silent.getsockname()[1]
+        self.manager.refresh_all()
+
+        connecting = threading.Thread(
+            target=self.manager.ssh_manager.get_jumpbox_client, args=(silent_address, "jump", "jump")
+        )
+        connecting.start()
+        try:
+            time.sleep(0.2)
+            start = time.time()
+            self.assertTrue(self.manager.refresh_instance("10.0.0.1-0"))
+            self.assertLess(time.time() - start, 1)
+        finally:
+            silent.close()
+            connecting.join()
+
+    def test_reconnects_after_connection_loss(self):
+        self.manager.refresh_all()
+        for client in self.manager.ssh_manager.jumpbox_clients.values():
+            client.get_transport().close()
+
+        self.assertTrue(self.manager.refresh_instance("10.0.0.1-0"))
+        counters = self.manager.get_ssh_stats()["jumpboxes"][self.jumpbox.address]
+        self.assertEqual(counters["connects"], 2)
+        self.assertEqual(counters["reconnects"], 1)
+
+    def test_oversized_file_keeps_host_online(self):
+        target = self.jumpbox.targets["10.0.0.1"]
+        target.set_file(f"{self.path}.0", json_bytes({"Blob": base64.b64encode(os.urandom(200000)).decode("ascii")}))
+        self.manager.ssh_manager.max_line_bytes = 100000
+
+        results = self.manager.refresh_all(["10.0.0.1-0", "10.0.0.1-1"])
+        self.assertEqual(results, {"10.0.0.1-0": False, "10.0.0.1-1": True})
+        self.assertTrue(self.manager.instances["10.0.0.1-0"].online)
+        self.assertTrue(self.manager.instances["10.0.0.1-1"].online)
+
+    def test_many_files_in_one_read(self):
+        target = self.jumpbox.targets["10.0.0.1"]
+        paths = [rf"C:\Users\maa\Desktop\maa 实例's {index}\config\gui.json" for index in range(40)]
+        for path in paths:
+            target.set_file(path, json_bytes({"Path": path}))
+        ssh_manager = self.manager.ssh_manager
+        args = (self.jumpbox.address, self.jumpbox.username, self.jumpbox.password,
+                "10.0.0.1", target.username, target.password)
+
+        success, results = ssh_manager.read_files_via_jumpbox(*args, paths)
+        self.assertTrue(success)
+        self.assertEqual([json.loads(results[path]["data"])["Path"] for path in paths], paths)
+
+        known = {path: result["hash"] for path, result in results.items()}
+        success, results = ssh_manager.read_files_via_jumpbox(*args, paths, known)
+        self.assertEqual({result["status"] for result in results.values()}, {"unchanged"})
+
+    def test_failed_push_backs_off_when_host_goes_down(self):
+        self.manager.refresh_all()
+        instance = self.manager.instances["10.0.0.1-0"]
+        self.jumpbox.targets["10.0.0.1"].online = False
+
+        config = dict(instance.config, Current="Changed")
+        self.assertFalse(self.manager.update_config("10.0.0.1-0", config))
+        self.assertTrue(instance.dirty)
+        self.assertFalse(instance.online)
+
+        scheduler = SyncScheduler(self.manager, retry_interval=5, max_backoff=600)
+        delays = [scheduler.run_once("10.0.0.1-0") for _ in range(4)]
+        self.assertEqual(delays, [5, 10, 20, 40])
+        self.assertFalse(instance.online)
+
+    def test_sync_all_revalidates_with_hashes(self):
+        self.manager.refresh_all()
+        for instance in self.manager.instances.values():
+            instance.last_update = 0
+        self.jumpbox.stats.reset()
+
+        self.manager.sync_all()
+        stats = self.jumpbox.stats.snapshot()
+        self.assertEqual(stats["round_trips"], len(self.hosts))
+        self.assertLess(stats["bytes_out"], 2000)
+
+
+class TestBatchReadLimits(unittest.TestCase):
+    def test_corrupted_and_oversized_lines(self):
+        ssh_manager = SSHConnectionManager(max_line_bytes=64)
+        payload = base64.b64encode(gzip.compress(b'{"a": 1}')).decode('ascii')
+        output = f"0\tOK\tabc\t{payload[:-8]}\r\n1\tOK\tdef\t{payload}\r\n".encode('ascii')
+        ssh_manager.stream_command_via_jumpbox = lambda *args, **kwargs: fake_stream(output)
+        success, results = ssh_manager.read_files_via_jumpbox(
+            "jumpbox", "user", "pass", "target", "user", "pass", ["a.json", "b.json"]
+        )
+        self.assertTrue(success)
+        self.assertEqual(results["a.json"]["status"], "error")
+        self.assertEqual(results["b.json"]["data"], b'{"a": 1}')
+
+        # 超长行只影响对应的文件
+        big = base64.b64encode(gzip.compress(os.urandom(200))).decode('ascii')
+        output = f"0\tOK\tabc\t{big}\r\n1\tOK\tdef\t{payload}\r\n".encode('ascii')
+        ssh_manager.stream_command_via_jumpbox = lambda *args, **kwargs: fake_stream(output)
+        success, results = ssh_manager.read_files_via_jumpbox(
+            "jumpbox", "user", "pass", "target", "user", "pass", ["a.json", "b.json"]
+        )
+        self.assertTrue(success)
+        self.assertEqual(results["a.json"]["status"], "error")
+        self.assertIn("exceeds", results["a.json"]["error"])
+        self.assertEqual(results["b.json"]["data"], b'{"a": 1}')
+
+    def test_partial_output_is_not_a_connection_failure(self):
+        ssh_manager = SSHConnectionManager()
+        payload = base64.b64encode(gzip.compress(b'{"a": 1}')).decode('ascii')
+        line = f"0\tOK\tabc\t{payload}\r\n".encode('ascii')
+        paths = ["a.json", "b.json"]
+
+        # 超出输出上限：已返回的文件照常使用，其余文件报错
+        ssh_manager.stream_command_via_jumpbox = lambda *args, **kwargs: fake_stream(
+            line + b"1\tOK\tdef\t" + b"A" * 100, max_output_bytes=len(line) + 20)
+        success, results = ssh_manager.read_files_via_jumpbox("j", "u", "p", "t", "u", "p", paths)
+        self.assertTrue(success)
+        self.assertEqual(results["a.json"]["data"], b'{"a": 1}')
+        self.assertIn("exceeded", results["b.json"]["error"])
+
+        # 脚本中途出错退出
+        ssh_manager.stream_command_via_jumpbox = lambda *args, **kwargs: fake_stream(line, b"boom", exit_code=1)
+        success, results = ssh_manager.read_files_via_jumpbox("j", "u", "p", "t", "u", "p", paths)
+        self.assertTrue(success)
+        self.assertEqual(results["b.json"]["error"], "boom")
+
+        # 连接失败或没有任何输出才视为失败
+        ssh_manager.stream_command_via_jumpbox = lambda *args, **kwargs: CommandStream(None, 1024, 5, error="refused")
+        self.assertEqual(ssh_manager.read_files_via_jumpbox("j", "u", "p", "t", "u", "p", paths), (False, {}))
+        ssh_manager.stream_command_via_jumpbox = lambda *args, **kwargs: fake_stream(b"", b"unreachable", exit_code=255)
+        self.assertEqual(ssh_manager.read_files_via_jumpbox("j", "u", "p", "t", "u", "p", paths), (False, {}))
+
+    def test_path_list_sent_over_stdin(self):
+        ssh_manager = SSHConnectionManager()
+        sent = {}
+
+        def stream(*args, **kwargs):
+            sent["command"] = args[6]
+            sent["input_data"] = kwargs["input_data"]
+            return fake_stream(b"")
+
+        ssh_manager.stream_command_via_jumpbox = stream
+        paths = [rf"C:\Users\maa\Desktop\maa{index}\config\gui.json" for index in range(200)]
+        ssh_manager.read_files_via_jumpbox(
+            "jumpbox", "user", "pass", "target", "user", "pass", paths, {paths[0]: "a" * 64}
+        )
+        # 命令长度与文件数量无关，远远低于cmd的8191字符限制
+        self.assertLess(len(sent["command"]), 4000)
+        entries = base64.b64decode(sent["input_data"]).decode("utf-8").split("\n")
+        self.assertEqual(entries[0], paths[0] + "\t" + "a" * 64)
+        self.assertEqual(entries[-1], paths[-1] + "\t")
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
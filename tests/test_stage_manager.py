@@ -5,6 +5,7 @@ import shutil
 import tempfile
 from datetime import datetime, timedelta
 from stage_manager import StageDataManager
+from change_feed import ChangeFeed
 
 
 class TestStageManager(unittest.TestCase):
@@ -142,6 +143,40 @@ class TestStageManager(unittest.TestCase):
 
         self.assertTrue(ce6_found, "周二应该开放CE-6")
 
+    def test_cache_per_client_type(self):
+        """测试不同客户端类型分别缓存"""
+        official = self.stage_manager.get_stage_data('Official')
+        jp = self.stage_manager.get_stage_data('YoStarJP')
+        self.assertTrue(self.stage_manager.is_cache_valid('Official'))
+        self.assertTrue(self.stage_manager.is_cache_valid('YoStarJP'))
+        self.assertIs(self.stage_manager.get_stage_data('Official'), official)
+        self.assertIs(self.stage_manager.get_stage_data('YoStarJP'), jp)
+
+    def test_change_feed_events(self):
+        """测试关卡数据更新和活动结束时发布变更事件"""
+        feed = ChangeFeed()
+        self.stage_manager.change_feed = feed
+        with open(os.path.join(self.temp_dir, 'gui/StageActivity.json'), 'r', encoding='utf-8') as f:
+            activity_data = json.load(f)
+        self.stage_manager.fetch_api_with_cache = lambda path: activity_data if 'StageActivity' in path else None
+
+        self.stage_manager.get_stage_data(force_refresh=True)
+        self.stage_manager.get_stage_data(force_refresh=True)
+        events, _ = feed.since(0)
+        self.assertEqual([event['type'] for event in events], ['stage_data'])
+
+        self.stage_manager.get_open_stages()
+        ended = (datetime.now() - timedelta(days=1)).isoformat()
+        self.stage_manager.cached_stage_data['Official']['activity'][0]['activity']['utcExpireTime'] = ended
+        self.stage_manager.get_open_stages()
+        self.stage_manager.get_open_stages()
+
+        events, _ = feed.since(1)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['type'], 'open_stages')
+        self.assertEqual(events[0]['data']['closed'], ['EA-8'])
+        self.assertEqual(events[0]['data']['opened'], [])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file